@@ -3,6 +3,7 @@ from swyft.lightning.core import *
 from swyft.lightning.estimators import *
 from swyft.lightning.data import *
 from swyft.lightning.simulator import *
+from swyft.lightning.cache import *
 from swyft.lightning.utils import *
 from swyft.plot import *
 
@@ -4,6 +4,7 @@ from swyft.lightning.core import *
 from swyft.lightning.estimators import *
 from swyft.lightning.bounds import *
 from swyft.lightning.simulator import *
+from swyft.lightning.cache import *
 from swyft.lightning.data import *
 from swyft.lightning.utils import *
 
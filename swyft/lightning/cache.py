@@ -0,0 +1,474 @@
+import hashlib
+import json
+import os
+import sys
+from collections import OrderedDict
+from typing import Callable
+import numpy as np
+import torch
+import fasteners
+
+
+#########
+# Hashing
+#########
+
+
+def _update_hash(h, x):
+    if isinstance(x, torch.Tensor):
+        x = x.detach().cpu().numpy()
+    if isinstance(x, np.ndarray):
+        h.update(("ndarray%s%s" % (x.dtype.str, x.shape)).encode())
+        h.update(np.ascontiguousarray(x).tobytes())
+    elif isinstance(x, (tuple, list)):
+        h.update(("%s%i" % (type(x).__name__, len(x))).encode())
+        for v in x:
+            _update_hash(h, v)
+    elif isinstance(x, dict):
+        h.update(("dict%i" % len(x)).encode())
+        for k in sorted(x.keys()):
+            _update_hash(h, k)
+            _update_hash(h, x[k])
+    else:
+        h.update(("%s%r" % (type(x).__name__, x)).encode())
+
+
+def hash_values(*values):
+    """Content hash of (nested tuples, lists and dicts of) arrays, tensors and python values.
+
+    Returns:
+        str: Hex digest
+    """
+    h = hashlib.sha1()
+    _update_hash(h, values)
+    return h.hexdigest()
+
+
+def _nbytes(x):
+    if isinstance(x, torch.Tensor):
+        return x.element_size() * x.nelement()
+    elif isinstance(x, np.ndarray):
+        return x.nbytes
+    elif isinstance(x, (tuple, list)):
+        return sum(_nbytes(v) for v in x)
+    else:
+        return sys.getsizeof(x)
+
+
+def _copy(x):
+    if isinstance(x, torch.Tensor):
+        return x.clone()
+    elif isinstance(x, np.ndarray):
+        return x.copy()
+    elif isinstance(x, tuple):
+        return tuple(_copy(v) for v in x)
+    elif isinstance(x, list):
+        return [_copy(v) for v in x]
+    else:
+        return x
+
+
+########
+# Caches
+########
+
+
+class MemoryCache:
+    """In-memory least-recently-used (LRU) cache with byte-size accounting.
+
+    Cached values are copied when stored and when retrieved, such that
+    in-place operations on returned arrays do not alter the cache.
+
+    Args:
+        max_bytes: Maximum total size of cached values in bytes.
+    """
+
+    def __init__(self, max_bytes: int = 2**28):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __repr__(self):
+        return "MemoryCache(%s)" % self.stats()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key: str):
+        """Retrieve cached value.
+
+        Raises:
+            KeyError: If `key` is not cached.
+        """
+        try:
+            value, nbytes = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            raise
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return _copy(value)
+
+    def put(self, key: str, value):
+        """Store value, evicting least-recently-used values if necessary.
+
+        Values larger than `max_bytes` are not stored.
+        """
+        nbytes = _nbytes(value)
+        if nbytes > self.max_bytes:
+            return
+        if key in self._entries:
+            self.nbytes -= self._entries.pop(key)[1]
+        while self.nbytes + nbytes > self.max_bytes:
+            _, (_, n) = self._entries.popitem(last=False)
+            self.nbytes -= n
+        self._entries[key] = (_copy(value), nbytes)
+        self.nbytes += nbytes
+
+    def clear(self):
+        """Remove all cached values and reset counters."""
+        self._entries.clear()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        """Returns dictionary with hit/miss counters and size information."""
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            entries=len(self._entries),
+            nbytes=self.nbytes,
+            max_bytes=self.max_bytes,
+        )
+
+
+class DiskCache:
+    """Persistent least-recently-used (LRU) cache in a local directory.
+
+    Each cached value is stored as one or more `.npy` files, together with a
+    small JSON manifest which is written last.  Access times are tracked via
+    the modification time of the manifest.  The total size of all entries is
+    kept in an index file, such that entries are only scanned when values
+    need to be evicted.  Writes and evictions are protected by an
+    inter-process lock, such that several processes can safely share the
+    same cache directory.
+
+    Hit and miss counters of each process are written to the cache
+    directory as well, such that `stats` includes all processes that share
+    the cache (e.g. DataLoader workers).  Counters of processes that have
+    exited are merged into one file.
+
+    Values that cannot be written (e.g. because the disk is full) are
+    skipped, such that the cache never fails the calling process.
+
+    Args:
+        path: Cache directory.
+        version: Version tag that is part of all keys.  Change it to invalidate
+            cached values, e.g. after modifying the simulator.
+        max_bytes: Maximum total size of cached values on disk in bytes.
+    """
+
+    def __init__(self, path: str, version: str = "", max_bytes: int = 2**34):
+        self.path = path
+        self.version = version
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._stats_file = None
+        self._pid = None
+        os.makedirs(os.path.join(path, ".stats"), exist_ok=True)
+        self.lock = fasteners.InterProcessLock(os.path.join(path, ".lock.file"))
+
+    def __repr__(self):
+        return "DiskCache(%r, version=%r)" % (self.path, self.version)
+
+    def _filename(self, key):
+        digest = hashlib.sha1((self.version + "/" + key).encode()).hexdigest()
+        return os.path.join(self.path, digest)
+
+    def __contains__(self, key):
+        return os.path.exists(self._filename(key) + ".json")
+
+    def get(self, key: str):
+        """Retrieve cached value.
+
+        Raises:
+            KeyError: If `key` is not cached.
+        """
+        filename = self._filename(key)
+        try:
+            with open(filename + ".json") as f:
+                manifest = json.load(f)
+            values = []
+            for i, kind in enumerate(manifest["kinds"]):
+                v = np.load("%s.%i.npy" % (filename, i))
+                if kind == "torch":
+                    v = torch.from_numpy(v)
+                elif kind == "scalar":
+                    v = v.item()
+                elif kind == "numpy_scalar":
+                    v = v[()]
+                values.append(v)
+            os.utime(filename + ".json")
+        except (OSError, ValueError):  # Missing, evicted or incomplete entry
+            self._count(misses=1)
+            raise KeyError(key)
+        self._count(hits=1)
+        return tuple(values) if manifest["multiple"] else values[0]
+
+    def put(self, key: str, value):
+        """Store value, evicting least-recently-used values if necessary.
+
+        Only arrays, tensors and scalars, or tuples/lists thereof, are stored.
+        Other values, values larger than `max_bytes`, and values that cannot
+        be written (e.g. because the disk is full) are skipped.
+        """
+        multiple = isinstance(value, (tuple, list))
+        values = value if multiple else [value]
+        arrays, kinds = [], []
+        for v in values:
+            if isinstance(v, torch.Tensor):
+                arrays.append(v.detach().cpu().numpy())
+                kinds.append("torch")
+            elif isinstance(v, np.ndarray) and v.dtype != object:
+                arrays.append(v)
+                kinds.append("numpy")
+            elif isinstance(v, (int, float, complex, bool)):
+                arrays.append(np.asarray(v))
+                kinds.append("scalar")
+            elif isinstance(v, np.generic):
+                arrays.append(np.asarray(v))
+                kinds.append("numpy_scalar")
+            else:
+                return
+        nbytes = sum(a.nbytes for a in arrays)
+        if nbytes > self.max_bytes:
+            return
+        filename = self._filename(key)
+        with self.lock:
+            total = self._get_total()
+            n_old = 0
+            try:
+                with open(filename + ".json") as f:
+                    manifest = json.load(f)
+                total -= manifest["nbytes"]  # Overwritten entry
+                n_old = len(manifest["kinds"])
+            except (OSError, ValueError):
+                pass
+            try:
+                if total + nbytes > self.max_bytes:
+                    total = self._evict(self.max_bytes - nbytes)
+                for i, a in enumerate(arrays):
+                    np.save("%s.%i.npy" % (filename, i), a, allow_pickle=False)
+                manifest = dict(key=key, multiple=multiple, kinds=kinds, nbytes=nbytes)
+                with open(filename + ".json.tmp", "w") as f:
+                    json.dump(manifest, f)
+                os.replace(filename + ".json.tmp", filename + ".json")
+                self._set_total(total + nbytes)
+            except OSError:  # E.g. disk full, drop the (partially written) entry
+                self._remove(filename, max(n_old, len(arrays)))
+                try:
+                    self._set_total(total)
+                except OSError:
+                    pass
+
+    def _remove(self, filename, n):
+        """Removes entry `filename` with up to `n` arrays, including partial files."""
+        for name in [filename + ".json", filename + ".json.tmp"] + [
+            "%s.%i.npy" % (filename, i) for i in range(n)
+        ]:
+            try:
+                os.remove(name)
+            except FileNotFoundError:
+                pass
+
+    def _count(self, hits=0, misses=0):
+        """Updates hit/miss counters of this process and writes them to the cache directory."""
+        if self._pid != os.getpid():  # Forked processes count separately
+            self._pid = os.getpid()
+            self._stats_file = os.path.join(
+                self.path, ".stats", "%i-%s" % (self._pid, os.urandom(4).hex())
+            )
+            self.hits, self.misses = 0, 0
+            self._merge_stats()
+        self.hits += hits
+        self.misses += misses
+        try:
+            with open(self._stats_file + ".tmp", "w") as f:
+                json.dump(dict(hits=self.hits, misses=self.misses), f)
+            os.replace(self._stats_file + ".tmp", self._stats_file)
+        except OSError:  # Counters are best effort
+            pass
+
+    def _merge_stats(self):
+        """Merges counters of processes that have exited into one file."""
+        stats_dir = os.path.join(self.path, ".stats")
+        merged_file = os.path.join(stats_dir, "merged")
+        with self.lock:
+            exited = [
+                entry.path
+                for entry in os.scandir(stats_dir)
+                if entry.name.split("-")[0].isdigit()
+                and not _is_alive(int(entry.name.split("-")[0]))
+            ]
+            if not exited:
+                return
+            counts = dict(hits=0, misses=0)
+            for filename in exited + [merged_file]:
+                if filename.endswith(".tmp"):
+                    continue
+                try:
+                    with open(filename) as f:
+                        for k, v in json.load(f).items():
+                            counts[k] += v
+                except (OSError, ValueError):
+                    pass
+            try:
+                with open(merged_file + ".tmp", "w") as f:
+                    json.dump(counts, f)
+                os.replace(merged_file + ".tmp", merged_file)
+            except OSError:
+                return
+            for filename in exited:
+                os.remove(filename)
+
+    def _get_total(self):
+        """Returns total size of entries from the index (cache must be locked)."""
+        try:
+            with open(os.path.join(self.path, ".index")) as f:
+                return json.load(f)["nbytes"]
+        except (OSError, ValueError, KeyError):  # Missing or corrupt index
+            return sum(e[1] for e in self._entries())
+
+    def _set_total(self, nbytes):
+        filename = os.path.join(self.path, ".index")
+        with open(filename + ".tmp", "w") as f:
+            json.dump(dict(nbytes=nbytes), f)
+        os.replace(filename + ".tmp", filename)
+
+    def _entries(self):
+        """Returns list of (access time, nbytes, filename, number of arrays) for all entries."""
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith(".json"):
+                try:
+                    with open(entry.path) as f:
+                        manifest = json.load(f)
+                    atime = entry.stat().st_mtime
+                except (OSError, ValueError):
+                    continue
+                filename = entry.path[: -len(".json")]
+                n = len(manifest["kinds"])
+                entries.append((atime, manifest["nbytes"], filename, n))
+        return entries
+
+    def _evict(self, max_bytes):
+        """Evicts least-recently-used entries until at most `max_bytes` are left.
+
+        Returns:
+            Total size of the remaining entries.
+        """
+        entries = sorted(self._entries())
+        total = sum(e[1] for e in entries)
+        for _, nbytes, filename, n in entries:
+            if total <= max_bytes:
+                break
+            os.remove(filename + ".json")  # Invalidate entry first
+            for i in range(n):
+                os.remove("%s.%i.npy" % (filename, i))
+            total -= nbytes
+        self._set_total(total)
+        return total
+
+    def clear(self):
+        """Remove all cached values and reset counters."""
+        with self.lock:
+            self._evict(0)
+            for entry in os.scandir(os.path.join(self.path, ".stats")):
+                os.remove(entry.path)
+        self.hits = 0
+        self.misses = 0
+        self._pid = None
+
+    def stats(self):
+        """Returns dictionary with hit/miss counters and size information."""
+        entries = self._entries()
+        hits, misses = 0, 0
+        for entry in os.scandir(os.path.join(self.path, ".stats")):
+            if entry.name.endswith(".tmp"):
+                continue
+            try:
+                with open(entry.path) as f:
+                    counts = json.load(f)
+            except (OSError, ValueError):
+                continue
+            hits += counts["hits"]
+            misses += counts["misses"]
+        return dict(
+            hits=hits,
+            misses=misses,
+            entries=len(entries),
+            nbytes=sum(e[1] for e in entries),
+            max_bytes=self.max_bytes,
+        )
+
+
+def _is_alive(pid):
+    """True if a process with id `pid` is running on this host."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, OverflowError):
+        return True
+    return True
+
+
+class CachedFunction:
+    """Memoizes a deterministic function, using the content hash of its arguments as key.
+
+    Args:
+        fn: Deterministic function.
+        cache: Cache instance, providing `get` and `put` methods.
+        name: Name that is prefixed to all keys, to allow sharing caches between functions.
+    """
+
+    def __init__(self, fn: Callable, cache, name: str = ""):
+        self.fn = fn
+        self.cache = cache
+        self.name = name
+
+    def __repr__(self):
+        return "CachedFunction(%r, %r)" % (self.fn, self.cache)
+
+    def _get_key(self, args, kwargs):
+        values = (*args, kwargs) if kwargs else args
+        return self.name + ":" + hash_values(*values)
+
+    def __call__(self, *args, **kwargs):
+        key = self._get_key(args, kwargs)
+        try:
+            return self.cache.get(key)
+        except KeyError:
+            result = self.fn(*args, **kwargs)
+            self.cache.put(key, result)
+            return result
+
+
+class AsyncCachedFunction(CachedFunction):
+    """Memoizes a deterministic coroutine function (see `CachedFunction`)."""
+
+    async def __call__(self, *args, **kwargs):
+        key = self._get_key(args, kwargs)
+        try:
+            return self.cache.get(key)
+        except KeyError:
+            result = await self.fn(*args, **kwargs)
+            self.cache.put(key, result)
+            return result
@@ -1,4 +1,24 @@
+import contextlib
+import glob
+import hashlib
+import itertools
+import json
 import math
+import os
+import queue
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import uuid
+from collections.abc import MutableMapping
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
 from typing import (
     Callable,
     Dict,
@@ -15,9 +35,11 @@ import torch
 from torch.utils.data import random_split
 import pytorch_lightning as pl
 import zarr
+import numcodecs
 import fasteners
 import swyft
-from swyft.lightning.simulator import Samples, Sample
+from swyft.lightning.simulator import Samples, Sample, _spawn_seeds, _call_seeded
+from swyft.lightning.utils import collate_output
 
 
 ######################
@@ -35,6 +57,11 @@ class SwyftDataModule(pl.LightningDataModule):
         batch_size: Minibatch size.
         num_workers: Number of workers for dataloader.
         shuffle: Shuffle training data.
+        on_after_load_sample: Callable, that is applied to individual training samples on the fly.
+        on_after_load_batch: Callable, that is applied to collated training minibatches on the fly (e.g. `BatchedSimulatorResampler`).
+        indices: Optional sample indices of a `ZarrStore` or `MemmapStore`
+            (e.g. from `ZarrStore.simulate(..., bounds=...)`), which are
+            randomly split into training, validation and test samples.
 
     Returns:
         pytorch_lightning.LightningDataModule
@@ -49,19 +76,24 @@ class SwyftDataModule(pl.LightningDataModule):
         num_workers: int = 0,
         shuffle: bool = False,
         on_after_load_sample: Optional[callable] = None,
+        on_after_load_batch: Optional[callable] = None,
+        indices: Optional[Sequence[int]] = None,
     ):
         super().__init__()
         self.data = data
+        self.indices = indices
+        N = len(data) if indices is None else len(indices)
         if lengths is not None and fractions is None:
             self.lengths = lengths
         elif lengths is None and fractions is not None:
-            self.lengths = self._get_lengths(fractions, len(data))
+            self.lengths = self._get_lengths(fractions, N)
         else:
             raise ValueError("Either lenghts or fraction must be set, but not both.")
         self.batch_size = batch_size
         self.num_workers = num_workers
         self.shuffle = shuffle
         self.on_after_load_sample = on_after_load_sample
+        self.on_after_load_batch = on_after_load_batch
 
     @staticmethod
     def _get_lengths(fractions, N):
@@ -79,7 +111,19 @@ class SwyftDataModule(pl.LightningDataModule):
             )
             splits = torch.utils.data.random_split(dataset, self.lengths)
             self.dataset_train, self.dataset_val, self.dataset_test = splits
-        elif isinstance(self.data, swyft.ZarrStore):
+        elif self.indices is not None and isinstance(
+            self.data, (swyft.ZarrStore, swyft.MemmapStore)
+        ):
+            indices = np.random.default_rng(0).permutation(self.indices)
+            bounds = np.cumsum([0] + list(self.lengths))
+            self.dataset_train, self.dataset_val, self.dataset_test = [
+                self.data.get_dataset(
+                    indices=indices[bounds[i] : bounds[i + 1]],
+                    on_after_load_sample=self.on_after_load_sample if i == 0 else None,
+                )
+                for i in range(3)
+            ]
+        elif isinstance(self.data, (swyft.ZarrStore, swyft.MemmapStore)):
             idxr1 = (0, self.lengths[1])
             idxr2 = (self.lengths[1], self.lengths[1] + self.lengths[2])
             idxr3 = (self.lengths[1] + self.lengths[2], len(self.data))
@@ -101,6 +145,7 @@ class SwyftDataModule(pl.LightningDataModule):
             batch_size=self.batch_size,
             shuffle=self.shuffle,
             num_workers=self.num_workers,
+            collate_fn=get_collate_fn(self.on_after_load_batch),
         )
         return dataloader
 
@@ -140,6 +185,33 @@ class SamplesDataset(torch.utils.data.Dataset):
         return d
 
 
+class BatchHookCollate:
+    """Collate function that applies a hook to collated minibatches.
+
+    Samples are stacked as arrays/tensors, passed to `on_after_load_batch`,
+    and only then converted to torch tensors.
+    """
+
+    def __init__(self, on_after_load_batch):
+        self.on_after_load_batch = on_after_load_batch
+
+    def __call__(self, samples):
+        batch = collate_output(samples)
+        batch = self.on_after_load_batch(batch)
+        return torch.utils.data.default_convert(dict(batch))
+
+
+def get_collate_fn(on_after_load_batch=None):
+    """Returns collate function for DataLoaders, or None for torch's default collate function.
+
+    Args:
+        on_after_load_batch: Optional callable, that is applied to collated minibatches.
+    """
+    if on_after_load_batch is None:
+        return None
+    return BatchHookCollate(on_after_load_batch)
+
+
 class RepeatDatasetWrapper(torch.utils.data.Dataset):
     def __init__(self, dataset, repeat):
         self._dataset = dataset
@@ -165,8 +237,14 @@ class ZarrStore:
             sync_path = file_path + ".sync"
         synchronizer = zarr.ProcessSynchronizer(sync_path) if sync_path else None
         self.store = zarr.DirectoryStore(file_path)
-        self.root = zarr.group(store=self.store, synchronizer=synchronizer)
+        # Attributes hold bookkeeping shared between processes, don't cache them
+        self.root = zarr.group(
+            store=self.store, synchronizer=synchronizer, cache_attrs=False
+        )
         self.lock = fasteners.InterProcessLock(file_path + ".lock.file")
+        self._write_buffer = _ChunkWriteBuffer(self)
+        self._open_lease = None  # Leased slots not handed out yet, see `_take_slots`
+        self.chunk_cache = None
 
     def reset_length(self, N, clubber=False):
         """Resize store.  N >= current store length."""
@@ -175,36 +253,158 @@ class ZarrStore:
                 """New length shorter than current store length.
                 You can use clubber = True if you know what your are doing."""
             )
+        with self.lock:
+            length = len(self)
+            self._resize(N)
+            # Turn unused capacity into pending slots
+            sim_status = self.root["meta/sim_status"]
+            if N > length:
+                status = sim_status[length:N]
+                status[status == 3] = 0
+                sim_status[length:N] = status
+            self.data.attrs["length"] = N
+            self._update_chunk_pending(min(N, length) // self.chunk_size)
+            if N > length:
+                self._hold_leased_chunks(np.flatnonzero(status == 0) + length)
+
+    def _resize(self, capacity):
+        """Resize all arrays; new slots are pending (store must be locked)."""
         for k in self.data.keys():
             shape = self.data[k].shape
-            self.data[k].resize(N, *shape[1:])
+            self.data[k].resize(capacity, *shape[1:])
         self.root["meta/sim_status"].resize(
-            N,
+            capacity,
         )
+        n_chunks = int(math.ceil(capacity / self.chunk_size))
+        for k in self.zonemap_keys:
+            for name in ["zonemap_min", "zonemap_max"]:
+                zonemap = self.root["meta"][name][k]
+                zonemap.resize(n_chunks, zonemap.shape[1])
+
+    @property
+    def capacity(self):
+        """Number of allocated slots, which is at least the store length."""
+        keys = self.root["data"].keys()
+        ns = [len(self.root["data"][k]) for k in keys]
+        N = ns[0]
+        assert all([n == N for n in ns])
+        return N
+
+    def _extend(self, n):
+        """Extends store length by `n` slots (store must be locked).
+
+        Capacity is grown geometrically, such that repeated extensions have
+        amortized constant cost per slot.  New slots beyond the store length
+        are marked as unused capacity (status 3).
 
-    def init(self, N, chunk_size, shapes=None, dtypes=None):
+        Returns:
+            Start and stop of the new slots, which have status 3.
+        """
+        length, capacity = len(self), self.capacity
+        if length + n > capacity:
+            new_capacity = max(length + n, 2 * capacity)
+            self._resize(new_capacity)
+            self.root["meta/sim_status"][capacity:new_capacity] = 3
+            self._update_chunk_pending(capacity // self.chunk_size)
+        self.data.attrs["length"] = length + n
+        return length, length + n
+
+    def grow(self, n):
+        """Extends store length by `n` pending slots.
+
+        Returns:
+            Indices of the new slots.
+        """
+        with self.lock:
+            start, stop = self._extend(n)
+            self.root["meta/sim_status"][start:stop] = 0
+            self._update_counters(np.arange(start, stop), 1)
+            self._hold_leased_chunks(np.arange(start, stop))
+        return np.arange(start, stop)
+
+    def append(self, samples):
+        """Appends samples at the end of the store, growing it if necessary.
+
+        If the last chunk of the store is leased by a running simulation, the
+        samples are appended from the next chunk on, and the slots in between
+        become pending slots.
+
+        Returns:
+            Indices of the appended samples.
+        """
+        with self.lock:
+            gap = -len(self) % self.chunk_size
+            if gap > 0 and self._get_chunk_leases([len(self) // self.chunk_size]):
+                start, stop = self._extend(gap)
+                self.root["meta/sim_status"][start:stop] = 0
+                self._update_counters(np.arange(start, stop), 1)
+                self._hold_leased_chunks(np.arange(start, stop))
+            start, stop = self._extend(len(samples))
+            for k, v in self.data.items():
+                v[start:stop] = np.asarray(samples[k])
+            self.root["meta/sim_status"][start:stop] = 1
+            self._update_zonemaps(np.arange(start, stop), samples)
+            self._bump_generation()
+        if self.chunk_cache is not None:
+            self.chunk_cache.clear()
+        return np.arange(start, stop)
+
+    def init(
+        self,
+        N,
+        chunk_size,
+        shapes=None,
+        dtypes=None,
+        seed=None,
+        codecs=None,
+        zonemap_keys=None,
+    ):
+        """Initialize store.
+
+        Args:
+            N: Number of samples.
+            chunk_size: Number of samples per chunk.
+            shapes, dtypes: Dictionaries with shapes and dtypes of all sample variables.
+            seed: Optional integer seed.  If provided, `simulate` seeds all
+                simulator nodes from `(seed, slot index, node name)`, such that
+                store contents are reproducible and independent of
+                `num_workers`.
+            codecs: Optional dictionary with storage settings per sample
+                variable.  The key "*" sets defaults for all variables.  See
+                `get_codec_kwargs` for the available settings, e.g.
+                `{"*": dict(cname="zstd", clevel=3), "x": dict(dtype="bfloat16")}`.
+            zonemap_keys: Optional list of sample variables for which per-chunk
+                min/max statistics are maintained, see `select`.
+        """
         if len(self) > 0:
             print("WARNING: Already initialized.")
             return self
-        self._init_shapes(shapes, dtypes, N, chunk_size)
+        self._init_shapes(shapes, dtypes, N, chunk_size, codecs)
+        if seed is not None:
+            self.data.attrs["seed"] = int(seed)
+        with self.lock:
+            self._get_chunk_pending()
+        if zonemap_keys is not None:
+            self.enable_zonemaps(zonemap_keys)
         return self
 
     def __len__(self):
+        """Store length, which can be smaller than the allocated capacity."""
         if "data" not in self.root.keys():
             return 0
-        keys = self.root["data"].keys()
-        ns = [len(self.root["data"][k]) for k in keys]
-        N = ns[0]
-        assert all([n == N for n in ns])
-        return N
+        length = self.data.attrs.get("length")
+        return self.capacity if length is None else length
 
     def keys(self):
         return list(self.data.keys())
 
     def __getitem__(self, i):
         if isinstance(i, int):
+            if i >= len(self):
+                raise IndexError(i)
             return {k: self.data[k][i] for k in self.keys()}
         elif isinstance(i, slice):
+            i = slice(*i.indices(len(self)))
             return Samples({k: self.data[k][i] for k in self.keys()})
         elif isinstance(i, str):
             return self.data[i]
@@ -212,14 +412,17 @@ class ZarrStore:
             raise ValueError
 
     # TODO: Remove consistency checks
-    def _init_shapes(self, shapes, dtypes, N, chunk_size):
+    def _init_shapes(self, shapes, dtypes, N, chunk_size, codecs=None):
         """Initializes shapes, or checks consistency."""
+        codecs = {} if codecs is None else codecs
         for k in shapes.keys():
             s = shapes[k]
-            dtype = dtypes[k]
+            settings = dict(codecs.get("*", {}), **codecs.get(k, {}))
+            kwargs = get_codec_kwargs(dtypes[k], **settings)
+            dtype = kwargs["dtype"]
             try:
                 self.root.zeros(
-                    "data/" + k, shape=(N, *s), chunks=(chunk_size, *s), dtype=dtype
+                    "data/" + k, shape=(N, *s), chunks=(chunk_size, *s), **kwargs
                 )
             except zarr.errors.ContainsArrayError:
                 assert self.root["data/" + k].shape == (
@@ -243,17 +446,23 @@ class ZarrStore:
             assert self.chunk_size == chunk_size, "Inconsistent chunk size"
         except KeyError:
             self.data.attrs["chunk_size"] = chunk_size
+            self.data.attrs["length"] = N
+            self.data.attrs["store_id"] = uuid.uuid4().hex
 
     @property
     def chunk_size(self):
         return self.data.attrs["chunk_size"]
 
+    @property
+    def seed(self):
+        return self.data.attrs.get("seed")
+
     @property
     def data(self):
         return self.root["data"]
 
     def numpy(self):
-        return {k: v[:] for k, v in self.root["data"].items()}
+        return {k: v[: len(self)] for k, v in self.root["data"].items()}
 
     def get_sample_store(self):
         return Samples(self.numpy())
@@ -264,46 +473,1092 @@ class ZarrStore:
 
     @property
     def sims_required(self):
-        return sum(self.root["meta"]["sim_status"][:] == 0)
+        """Number of pending and leased slots."""
+        meta = self.root["meta"]
+        if "pending" not in meta.attrs:
+            with self.lock:
+                self._get_chunk_pending()
+        leased = sum(j1 - j0 for v in self.leases.values() for j0, j1 in v["slices"])
+        return meta.attrs["pending"] + leased
+
+    # Free-slot index
+    #
+    # `meta/sim_status` is 0 for pending, 1 for done and 2 for leased slots,
+    # and 3 for allocated slots beyond the store length.
+    # `meta/chunk_pending` counts the pending slots of each chunk of
+    # `meta/sim_status`, the `cursor` attribute points to the first chunk with
+    # pending slots, and the `pending` attribute holds the total count.  All
+    # methods below must be called while holding `self.lock`.
+
+    def _get_chunk_pending(self):
+        """Returns per-chunk pending counters, building them for older stores."""
+        meta = self.root["meta"]
+        if "chunk_pending" not in meta:
+            n_chunks = int(math.ceil(len(meta["sim_status"]) / self.chunk_size))
+            meta.zeros(
+                "chunk_pending", shape=(n_chunks,), chunks=(2**16,), dtype="i8"
+            )
+            self._update_chunk_pending(0)
+        return meta["chunk_pending"]
+
+    def _update_chunk_pending(self, c0):
+        """Recounts pending slots in chunks `c0` and following, e.g. after resizing."""
+        meta = self.root["meta"]
+        sim_status = meta["sim_status"]
+        chunk_pending = meta["chunk_pending"]
+        n_chunks = int(math.ceil(len(sim_status) / self.chunk_size))
+        chunk_pending.resize(n_chunks)
+        if c0 < n_chunks:
+            free = sim_status[c0 * self.chunk_size :] == 0
+            starts = np.arange(0, len(free), self.chunk_size)
+            chunk_pending[c0:] = (
+                np.add.reduceat(free.astype("i8"), starts) if len(free) else []
+            )
+        meta.attrs["cursor"] = min(meta.attrs.get("cursor", 0), c0)
+        meta.attrs["pending"] = int(chunk_pending[:].sum())
+        self._advance_cursor()
+
+    def _advance_cursor(self, window=1024):
+        """Moves cursor to the first chunk with pending slots."""
+        meta = self.root["meta"]
+        chunk_pending = meta["chunk_pending"]
+        cursor = meta.attrs["cursor"]
+        while cursor < len(chunk_pending):
+            nonzero = np.flatnonzero(chunk_pending[cursor : cursor + window])
+            if len(nonzero) > 0:
+                cursor += int(nonzero[0])
+                break
+            cursor += window
+        meta.attrs["cursor"] = min(cursor, len(chunk_pending))
 
-    def simulate(self, sampler, max_sims=None, batch_size=10):
+    def _find_free_slots(self, num_sims, window=1024):
+        """Returns indices of up to `num_sims` pending slots, starting at the cursor.
+
+        Only chunks with pending slots are read, such that the cost scales with
+        `num_sims` rather than with the store size.
+        """
+        meta = self.root["meta"]
+        sim_status = meta["sim_status"]
+        chunk_pending = self._get_chunk_pending()
+        chunk_size = self.chunk_size
+        idx = []
+        n = 0
+        c = meta.attrs["cursor"]
+        while n < num_sims and c < len(chunk_pending):
+            for j in np.flatnonzero(chunk_pending[c : c + window]):
+                i0 = (c + j) * chunk_size
+                free = np.flatnonzero(sim_status[i0 : i0 + chunk_size] == 0) + i0
+                idx.append(free[: num_sims - n])
+                n += len(idx[-1])
+                if n >= num_sims:
+                    break
+            c += window
+        return np.concatenate(idx) if idx else np.zeros(0, dtype=int)
+
+    def _update_counters(self, idx, sign):
+        """Updates pending counters after slots `idx` were taken (sign -1) or freed (sign 1)."""
+        if len(idx) == 0:
+            return
+        meta = self.root["meta"]
+        chunk_pending = self._get_chunk_pending()
+        chunks, counts = np.unique(
+            np.asarray(idx) // self.chunk_size, return_counts=True
+        )
+        chunk_pending.set_coordinate_selection(
+            chunks, chunk_pending.get_coordinate_selection(chunks) + sign * counts
+        )
+        meta.attrs["pending"] = meta.attrs["pending"] + sign * len(idx)
+        if sign > 0:
+            meta.attrs["cursor"] = min(meta.attrs["cursor"], int(chunks[0]))
+        self._advance_cursor()
+
+    def simulate(
+        self,
+        sampler,
+        max_sims=None,
+        batch_size=10,
+        num_workers=0,
+        lease_timeout=3600.0,
+        grow=False,
+        bounds=None,
+        prior=None,
+        key="z",
+    ):
+        """Run simulations and store results.
+
+        Slots are leased before simulating, such that concurrent processes
+        simulating into the same store never duplicate work.  Leases that are
+        not completed within `lease_timeout` seconds (e.g. because the worker
+        died) are reclaimed by other workers.
+
+        Args:
+            sampler: Simulator instance, or function that takes the number of
+                samples as argument and returns `Samples`.
+            max_sims: Maximum number of simulations to run.
+            batch_size: Number of simulations per batch.  Ignored for Simulator
+                instances, which stream their samples into the store one
+                chunk (`chunk_size` samples) at a time, using `Simulator.sample_iter`.
+            num_workers: If larger than zero, batches are simulated in parallel
+                by a pool of `num_workers` processes, each with independently
+                seeded random number generators.  Results are written to the
+                store as batches finish.
+            lease_timeout: Lease duration in seconds.
+            grow: If True, the store is extended (see `grow`) such that
+                `max_sims` pending slots are available.
+            bounds: Rectangular bounds of a truncation round (array of shape
+                (number of parameters, 2), as used by `RectBoundSampler`).  If
+                provided, `max_sims` samples from `prior` truncated to `bounds`
+                are obtained, reusing stored simulations where possible (see
+                below), and their indices are returned.
+            prior: Prior distribution(s) of `key`, as used by `RectBoundSampler`.
+                The returned indices can be passed to `get_dataset(indices=...)`
+                or `SwyftDataModule(store, indices=...)`.
+            key: Name of the parameter sample variable.
+
+        If the store was initialized with a `seed`, Simulator instances are
+        sampled with `Simulator.sample(seed=..., indices=...)`, using the slot
+        indices the samples are written to.
+
+        Reuse of stored simulations works as follows.  The store keeps track
+        of the intersection R of all bounds used so far (initially the full
+        prior), such that stored samples inside R are independent draws from
+        the prior truncated to R.  For a new round, R is intersected with the
+        new bounds B, and `max_sims` parameters are drawn from the prior
+        truncated to B.  For each draw that falls into R, an unused stored
+        sample from R is taken instead, while it lasts.  All remaining
+        draws are simulated, with parameters drawn from the prior truncated to
+        R or to B without R, respectively.  The returned samples hence follow
+        the prior truncated to B exactly, and only the shortfall is simulated.
+        Stores that were filled without bounds are assumed to contain prior
+        samples.
+        """
+        if bounds is not None:
+            return self._simulate_bounded(
+                sampler, max_sims, bounds, prior, key, num_workers, lease_timeout
+            )
+        if grow:
+            if max_sims is None:
+                raise ValueError("max_sims is required if grow=True.")
+            if max_sims > self.sims_required:
+                self.grow(max_sims - self.sims_required)
+        if max_sims is None:
+            max_sims = len(self)
+        try:
+            if isinstance(sampler, swyft.Simulator):
+                with _get_executor(sampler, num_workers) as executor:
+                    self._simulate_stream(
+                        sampler, max_sims, executor, num_workers, lease_timeout
+                    )
+            elif num_workers > 0:
+                self._simulate_parallel(
+                    sampler, max_sims, batch_size, num_workers, lease_timeout
+                )
+            else:
+                total_sims = 0
+                while total_sims < max_sims:
+                    num_sims = min(batch_size, max_sims - total_sims)
+                    num_sims = self._simulate_batch(sampler, num_sims, lease_timeout)
+                    if num_sims == 0:
+                        break
+                    total_sims += num_sims
+        finally:
+            self.flush()
+            if self.chunk_cache is not None:
+                self.chunk_cache.clear()
+
+    def flush(self):
+        """Write buffered samples of partially simulated chunks to the store.
+
+        Leased slots that were not simulated are returned to the pending slots.
+        """
+        self._write_buffer.flush()
+        self._return_slots()
+
+    def enable_chunk_cache(self, max_bytes=None, shared=False, path=None):
+        """Cache decompressed chunks read by datasets of this store across epochs.
+
+        Args:
+            max_bytes: Maximum size of cached chunks in bytes, least-recently-used
+                chunks are evicted first.  Defaults to 1 GiB, or to half of
+                the free space of the shared cache's file system if that is
+                smaller (e.g. Docker's 64 MB `/dev/shm`).
+            shared: If True, chunks are cached as files in shared memory
+                (`/dev/shm`, or `path`), such that DataLoader worker processes
+                share one cache.  Otherwise each process has its own in-memory
+                cache.  Note that DataLoader workers are recreated every epoch
+                (unless `persistent_workers=True`), such that an in-memory cache
+                only helps across epochs with `num_workers=0`.
+            path: Directory of the shared cache.
+
+        Returns:
+            ChunkCache, which provides hit/miss statistics via `stats()`.
+
+        Cached chunks are keyed by the store's data `generation`, which is
+        incremented whenever samples are written, such that chunks cached
+        before (also by other processes or store instances) are not returned.
+        """
+        if shared:
+            if path is None:
+                root = (
+                    "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+                )
+                digest = hashlib.sha1(os.path.abspath(self.store.path).encode())
+                path = os.path.join(root, "swyft-chunks-" + digest.hexdigest()[:12])
+            if max_bytes is None:
+                os.makedirs(path, exist_ok=True)
+                max_bytes = min(2**30, shutil.disk_usage(path).free // 2)
+            cache = swyft.DiskCache(path, max_bytes=max_bytes)
+        else:
+            cache = swyft.MemoryCache(max_bytes=max_bytes or 2**30)
+        self.chunk_cache = ChunkCache(cache)
+        return self.chunk_cache
+
+    def _simulate_bounded(
+        self, simulator, max_sims, bounds, prior, key, num_workers, lease_timeout
+    ):
+        if not isinstance(simulator, swyft.Simulator):
+            raise TypeError("Bounded simulation requires a Simulator instance.")
+        if max_sims is None:
+            raise ValueError("max_sims is required if bounds are provided.")
+        if self.sims_required > 0:
+            raise ValueError("Store has pending simulations, run simulate() first.")
+        bounds = _as_bounds(bounds)
+        region = self.data.attrs.get("reuse_bounds")
+        if region is None:
+            region = bounds
+        else:
+            region = np.array(region)
+            region = np.stack(
+                [
+                    np.maximum(region[:, 0], bounds[:, 0]),
+                    np.minimum(region[:, 1], bounds[:, 1]),
+                ],
+                axis=-1,
+            )
+            region[:, 1] = np.maximum(region[:, 0], region[:, 1])
+        if key not in self.zonemap_keys:
+            self.enable_zonemaps([key])
+
+        # Draw parameters, and replace draws inside the region by stored samples
+        sampler = swyft.RectBoundSampler(prior, bounds=bounds)
+        z = np.stack([sampler() for _ in range(max_sims)])
+        n_region = int(_in_bounds(z.reshape(max_sims, -1), region).sum())
+        available = np.random.permutation(self.select(region, key))
+        reused = available[: min(n_region, len(available))]
+
+        idx = [reused]
+        conditions = [
+            (n_region - len(reused), _TruncatedPrior(prior, region, key)),
+            (max_sims - n_region, _TruncatedPrior(prior, bounds, key, region)),
+        ]
+        try:
+            with _get_executor(simulator, num_workers) as executor:
+                for n, condition in conditions:
+                    if n > 0:
+                        idx.append(self.grow(n))
+                        self._simulate_stream(
+                            simulator,
+                            n,
+                            executor,
+                            num_workers,
+                            lease_timeout,
+                            condition,
+                        )
+        finally:
+            self.flush()
+            if self.chunk_cache is not None:
+                self.chunk_cache.clear()
+        self.data.attrs["reuse_bounds"] = region.tolist()
+        return np.sort(np.concatenate(idx))
+
+    def _simulate_stream(
+        self, simulator, max_sims, executor, num_workers, lease_timeout, conditions={}
+    ):
+        if executor is not None:
+            # One chunk per job
+            self._simulate_jobs(
+                lambda idx: simulator.submit(
+                    executor,
+                    len(idx),
+                    conditions=conditions,
+                    seed=self.seed,
+                    indices=idx,
+                ),
+                max_sims,
+                self.chunk_size,
+                2 * num_workers,
+                lease_timeout,
+            )
+            return
         total_sims = 0
-        if isinstance(sampler, swyft.Simulator):
-            sampler = sampler.sample
-        while self.sims_required > 0:
-            if max_sims is not None and total_sims >= max_sims:
+        while total_sims < max_sims:
+            lease, idx = self._take_slots(
+                min(self.chunk_size, max_sims - total_sims), lease_timeout
+            )
+            if len(idx) == 0:
                 break
-            num_sims = self._simulate_batch(sampler, batch_size)
-            total_sims += num_sims
+            for samples in simulator.sample_iter(
+                len(idx),
+                self.chunk_size,
+                conditions=conditions,
+                seed=self.seed,
+                indices=idx,
+            ):
+                self._write_buffer.add(samples, idx, lease)
+            total_sims += len(idx)
+
+    def _simulate_parallel(
+        self, sample_fn, max_sims, batch_size, num_workers, lease_timeout
+    ):
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            self._simulate_jobs(
+                lambda idx: executor.submit(
+                    _call_seeded, _spawn_seeds(1)[0], sample_fn, len(idx)
+                ),
+                max_sims,
+                batch_size,
+                2 * num_workers,
+                lease_timeout,
+            )
+
+    def _simulate_jobs(self, submit, max_sims, batch_size, max_pending, lease_timeout):
+        """Simulates up to `max_sims` leased slots in jobs of `batch_size` slots.
+
+        Slots are leased whenever fewer than `max_pending` jobs are pending,
+        such that workers stay busy until all slots are leased.  Results are
+        written to the store as jobs finish.
+
+        Args:
+            submit: Function that starts a job for slot indices `idx`, and
+                returns a future of the samples.
+        """
+        total_sims = 0
+        futures = {}
+        while True:
+            while total_sims < max_sims and len(futures) < max_pending:
+                num_sims = min(batch_size, max_sims - total_sims)
+                lease, idx = self._take_slots(num_sims, lease_timeout)
+                if len(idx) == 0:
+                    # Pending slots may still be held by running leases
+                    if not futures:
+                        max_sims = total_sims
+                    break
+                futures[submit(idx)] = (lease, idx)
+                total_sims += len(idx)
+            if not futures:
+                break
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                lease, idx = futures.pop(future)
+                self._write_buffer.add(future.result(), idx, lease)
+
+    def _simulate_batch(self, sample_fn, batch_size, lease_timeout=3600.0):
+        lease, idx = self._take_slots(batch_size, lease_timeout)
+        if len(idx) == 0:
+            return 0
 
-    def _simulate_batch(self, sample_fn, batch_size):
         # Run simulator
-        num_sims = min(batch_size, self.sims_required)
-        if num_sims == 0:
-            return num_sims
+        samples = sample_fn(len(idx))
+        self._write_buffer.add(samples, idx, lease)
+
+        return len(idx)
 
-        samples = sample_fn(num_sims)
+    def _lease_slots(self, num_sims, timeout):
+        """Lease at least `num_sims` pending slots for `timeout` seconds.
 
-        # Reserve slots
+        Leases are chunk-aligned: all pending slots of the leased chunks are
+        leased, such that no other worker writes into chunks of the lease.
+
+        Returns:
+            Lease id (or None if no slots were available) and slot indices.
+        """
         with self.lock:
+            self._reclaim_leases()
+            idx = self._find_free_slots(num_sims)
+            if len(idx) == 0:
+                return None, idx
             sim_status = self.root["meta"]["sim_status"]
-            data = self.root["data"]
+            i0 = idx[-1] // self.chunk_size * self.chunk_size
+            rest = np.flatnonzero(sim_status[i0 : i0 + self.chunk_size] == 0) + i0
+            idx = np.union1d(idx, rest)
+            slices = [j_slice for _, j_slice in _get_index_slices(idx)]
+            for j0, j1 in slices:
+                sim_status[j0:j1] = 2
+            self._update_counters(idx, -1)
+            lease = uuid.uuid4().hex
+            leases = self.leases
+            leases[lease] = dict(
+                worker="%s:%i" % (socket.gethostname(), os.getpid()),
+                deadline=time.time() + timeout,
+                slices=[[int(j0), int(j1)] for j0, j1 in slices],
+                extra=[],
+            )
+            self.root["meta"].attrs["leases"] = leases
+        return lease, idx
 
-            idx = np.arange(len(sim_status))[sim_status[:] == 0][:num_sims]
-            index_slices = _get_index_slices(idx)
+    def _take_slots(self, num_sims, timeout):
+        """Returns up to `num_sims` leased slots to simulate.
 
-            for i_slice, j_slice in index_slices:
-                sim_status[j_slice[0] : j_slice[1]] = 1
+        Slots are taken from chunk-aligned leases (see `_lease_slots`), which
+        are handed out over several calls.  Slots that are not taken until the
+        next `flush` are returned to the pending slots.
+
+        Returns:
+            List of lease ids and slot indices.
+        """
+        leases, idx = [], []
+        while num_sims > 0:
+            if self._open_lease is None:
+                lease, leased = self._lease_slots(num_sims, timeout)
+                if len(leased) == 0:
+                    break
+                self._write_buffer.expect(leased)
+                self._open_lease = (lease, leased)
+            lease, leased = self._open_lease
+            leases.append(lease)
+            idx.append(leased[:num_sims])
+            num_sims -= len(idx[-1])
+            self._open_lease = (lease, leased[len(idx[-1]) :])
+            if len(self._open_lease[1]) == 0:
+                self._open_lease = None
+        return leases, np.concatenate(idx) if idx else np.zeros(0, dtype=int)
+
+    def _return_slots(self):
+        """Returns leased slots that were not taken to the pending slots."""
+        if self._open_lease is None:
+            return
+        lease, idx = self._open_lease
+        self._open_lease = None
+        with self.lock:
+            idx = idx[self._get_owned(idx, [lease])]
+            if len(idx) > 0:
+                self.root["meta"]["sim_status"].set_coordinate_selection(idx, 0)
+                self._update_counters(idx, 1)
+            self._release_leases([lease], idx)
+
+    def _get_chunk_leases(self, chunks):
+        """Returns ids of active leases that cover slots of `chunks`."""
+        now = time.time()
+        return [
+            k
+            for k, v in self.leases.items()
+            if v["deadline"] >= now
+            and np.isin(_expand_slices(v["slices"]) // self.chunk_size, chunks).any()
+        ]
+
+    def _hold_leased_chunks(self, idx):
+        """Adds pending slots `idx` in leased chunks to their leases (store must be locked).
+
+        Slots are held by the lease of their chunk, without being simulated,
+        and are returned to the pending slots once the lease is completed.
+        Hence no other worker writes into chunks of active leases.
+        """
+        self._reclaim_leases()
+        chunk_ids = np.asarray(idx) // self.chunk_size
+        leases = self.leases
+        held_leases = self._get_chunk_leases(np.unique(chunk_ids))
+        for lease in held_leases:
+            chunks = np.unique(
+                _expand_slices(leases[lease]["slices"]) // self.chunk_size
+            )
+            held = idx[np.isin(chunk_ids, chunks)]
+            slices = [[int(j0), int(j1)] for _, (j0, j1) in _get_index_slices(held)]
+            leases[lease]["slices"] += slices
+            leases[lease]["extra"] = leases[lease].get("extra", []) + slices
+            for j0, j1 in slices:
+                self.root["meta"]["sim_status"][j0:j1] = 2
+            self._update_counters(held, -1)
+        if held_leases:
+            self.root["meta"].attrs["leases"] = leases
+
+    def _reclaim_leases(self):
+        """Return slots of expired leases to the pending slots (store must be locked).
+
+        Temporary chunk files left by the expired leases' workers (see
+        `_store_samples`) are removed.
+        """
+        sim_status = self.root["meta"]["sim_status"]
+        leases = self.leases
+        now = time.time()
+        expired = [k for k, v in leases.items() if v["deadline"] < now]
+        for lease in expired:
+            slices = leases.pop(lease)["slices"]
+            for j0, j1 in slices:
+                idx = np.flatnonzero(sim_status[j0:j1] == 2) + j0
+                sim_status.set_coordinate_selection(idx, 0)
+                self._update_counters(idx, 1)
+            self._remove_partial_files(
+                np.unique(_expand_slices(slices) // self.chunk_size)
+            )
+        if expired:
+            self.root["meta"].attrs["leases"] = leases
+
+    def _remove_partial_files(self, chunks):
+        """Removes temporary files of chunks `chunks`, written by `_StagingStore.to_files`."""
+        for k in self.root["data"].keys():
+            for c in chunks:
+                pattern = os.path.join(self.store.path, "data", k, "%i.*.partial" % c)
+                for filename in glob.glob(pattern):
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(filename)
+
+    @property
+    def leases(self):
+        """Dictionary of active leases, with worker id, deadline and slot ranges."""
+        return self.root["meta"].attrs.get("leases", {})
+
+    def _store_samples(self, samples, idx=None, lease=None):
+        """Store samples in free or leased slots.
+
+        Slots of valid leases are owned exclusively, down to whole chunks (see
+        `_lease_slots`).  Their chunks are encoded and written to temporary
+        files without holding the store lock, such that concurrent workers
+        write in parallel.  The files are only moved into place under the
+        lock, if the lease is still valid.  Hence a worker whose lease expired
+        never overwrites slots of the worker that took over its chunks.
+
+        Args:
+            samples: Samples to store.
+            idx: Optional slot indices for the samples.
+            lease: Optional lease id, or list of lease ids, for slots `idx`.
+                Slots that are not covered by a valid lease (e.g. because it
+                was reclaimed in the meantime) are only written if they are
+                still pending.
+
+        Returns:
+            Number of stored samples.
+        """
+        num_sims = len(samples)
+        if lease is None:
+            lease = []
+        elif isinstance(lease, str):
+            lease = [lease]
+
+        # Slots without valid lease are claimed and written under the lock
+        with self.lock:
+            sim_status = self.root["meta"]["sim_status"]
+            if idx is None:
+                idx = self._find_free_slots(num_sims)
+                owned = np.zeros(len(idx), dtype=bool)
+            else:
+                idx = np.asarray(idx)
+                owned = self._get_owned(idx, lease)
+            claimed = ~owned
+            if claimed.any():
+                claimed[claimed] = (
+                    sim_status.get_coordinate_selection(idx[claimed]) == 0
+                )
+                self._update_counters(idx[claimed], -1)
+                self._commit_samples(
+                    self.root["data"], _take(samples, claimed), idx[claimed]
+                )
+
+        if not owned.any():
+            return int(claimed.sum())
+
+        # Chunks of leased slots are staged without holding the lock, and
+        # without the (per-chunk) file locks of the synchronizer
+        samples, idx = _take(samples, owned), idx[owned]
+        chunk_ids = idx // self.chunk_size
+        staged = {}
+        for c in np.unique(chunk_ids):
+            staging = _StagingStore(self.store)
+            data = zarr.open_group(store=staging, mode="r+")["data"]
+            chunk_samples = _take(samples, chunk_ids == c)
+            for i_slice, j_slice in _get_index_slices(idx[chunk_ids == c]):
                 for k, v in data.items():
-                    data[k][j_slice[0] : j_slice[1]] = samples[k][
+                    v[j_slice[0] : j_slice[1]] = chunk_samples[k][
                         i_slice[0] : i_slice[1]
                     ]
+            staged[c] = staging.to_files()
+
+        with self.lock:
+            # Leases may have been reclaimed while staging
+            owned = self._get_owned(idx, lease)
+            for c, files in staged.items():
+                if owned[chunk_ids == c].all():
+                    _StagingStore.publish(files)
+                else:
+                    owned[chunk_ids == c] = False
+                    _StagingStore.discard(files)
+            samples, idx = _take(samples, owned), idx[owned]
+            self._commit_samples(None, samples, idx)
+            self._release_leases(lease, idx)
+
+        return int(claimed.sum()) + len(idx)
+
+    def _get_owned(self, idx, lease):
+        """Returns mask of slots `idx` that are covered by valid leases `lease`."""
+        leases = self.leases
+        owned = np.zeros(len(idx), dtype=bool)
+        for l in lease:
+            if l in leases:
+                owned |= np.isin(idx, _expand_slices(leases[l]["slices"]))
+        return owned
+
+    def _commit_samples(self, data, samples, idx):
+        """Writes `samples` to `data` (if not None) and marks slots `idx` as simulated (store must be locked)."""
+        sim_status = self.root["meta"]["sim_status"]
+        for i_slice, j_slice in _get_index_slices(idx):
+            sim_status[j_slice[0] : j_slice[1]] = 1
+            if data is not None:
+                for k, v in data.items():
+                    v[j_slice[0] : j_slice[1]] = samples[k][i_slice[0] : i_slice[1]]
+        self._update_zonemaps(idx, samples)
+        if len(idx) > 0:
+            self._bump_generation()
+
+    @property
+    def generation(self):
+        """Data generation, which is incremented whenever samples are written."""
+        return self.data.attrs.get("generation", 0)
+
+    def _get_cache_tag(self):
+        """Returns tag of the current data, which is part of chunk cache keys."""
+        attrs = self.data.attrs.asdict()
+        return "%s:%i" % (attrs.get("store_id", ""), attrs.get("generation", 0))
+
+    def _bump_generation(self):
+        """Increments the data generation (store must be locked)."""
+        self.data.attrs["generation"] = self.generation + 1
+
+    def _release_leases(self, lease, idx):
+        """Releases stored slots `idx` from leases (store must be locked).
+
+        Once only held slots are left, they are returned to the pending slots
+        and the lease is completed.
+        """
+        sim_status = self.root["meta"]["sim_status"]
+        leases = self.leases
+        for l in lease:
+            if l not in leases:
+                continue
+            leased = np.setdiff1d(_expand_slices(leases[l]["slices"]), idx)
+            extra = _expand_slices(leases[l].get("extra", []))
+            if np.isin(leased, extra).all():
+                leased = leased[sim_status.get_coordinate_selection(leased) == 2]
+                sim_status.set_coordinate_selection(leased, 0)
+                self._update_counters(leased, 1)
+                del leases[l]
+            else:
+                leases[l]["slices"] = [
+                    [int(j0), int(j1)] for _, (j0, j1) in _get_index_slices(leased)
+                ]
+        if lease:
+            self.root["meta"].attrs["leases"] = leases
+
+    # Zone maps
+    #
+    # `meta/zonemap_min/<key>` and `meta/zonemap_max/<key>` hold the
+    # element-wise minimum and maximum of all samples written to each chunk,
+    # with shape (number of chunks, number of elements per sample).  The
+    # statistics are conservative: they are never shrunk when slots are
+    # overwritten.
+
+    @property
+    def zonemap_keys(self):
+        return self.data.attrs.get("zonemap_keys", [])
+
+    def enable_zonemaps(self, keys):
+        """Maintain per-chunk min/max statistics for sample variables `keys`.
+
+        Statistics for already simulated samples are computed once.
+        """
+        with self.lock:
+            n_chunks = int(math.ceil(self.capacity / self.chunk_size))
+            sim_status = self.root["meta"]["sim_status"]
+            new_keys = [k for k in keys if k not in self.zonemap_keys]
+            for k in new_keys:
+                size = int(np.prod(self.data[k].shape[1:], dtype=int))
+                for name, fill_value in [
+                    ("zonemap_min", np.inf),
+                    ("zonemap_max", -np.inf),
+                ]:
+                    self.root["meta"].full(
+                        "%s/%s" % (name, k),
+                        fill_value,
+                        shape=(n_chunks, size),
+                        chunks=(2**12, size),
+                        dtype="f8",
+                    )
+            self.data.attrs["zonemap_keys"] = self.zonemap_keys + new_keys
+            for c in range(n_chunks):
+                i0, i1 = c * self.chunk_size, (c + 1) * self.chunk_size
+                idx = np.flatnonzero(sim_status[i0:i1] == 1) + i0
+                if len(idx) > 0:
+                    samples = {k: self.data[k][i0:i1][idx - i0] for k in new_keys}
+                    self._update_zonemaps(idx, samples, new_keys)
+
+    def _update_zonemaps(self, idx, samples, keys=None):
+        """Updates zone maps after writing `samples` to slots `idx` (store must be locked)."""
+        keys = self.zonemap_keys if keys is None else keys
+        if len(idx) == 0 or not keys:
+            return
+        chunk_ids = np.asarray(idx) // self.chunk_size
+        order = np.argsort(chunk_ids, kind="stable")
+        chunks, starts = np.unique(chunk_ids[order], return_index=True)
+        for k in keys:
+            values = _roundtrip(self.root["data"][k], np.asarray(samples[k]))
+            values = values.reshape(len(idx), -1)[order]
+            zonemap_min = self.root["meta"]["zonemap_min"][k]
+            zonemap_max = self.root["meta"]["zonemap_max"][k]
+            zonemap_min.set_orthogonal_selection(
+                (chunks, slice(None)),
+                np.minimum(
+                    zonemap_min.get_orthogonal_selection((chunks, slice(None))),
+                    np.minimum.reduceat(values, starts),
+                ),
+            )
+            zonemap_max.set_orthogonal_selection(
+                (chunks, slice(None)),
+                np.maximum(
+                    zonemap_max.get_orthogonal_selection((chunks, slice(None))),
+                    np.maximum.reduceat(values, starts),
+                ),
+            )
+
+    def select(self, bounds, key="z", return_samples=False):
+        """Find simulated samples with `key` inside rectangular bounds.
+
+        Chunks whose zone map lies outside the bounds are skipped, such that
+        only chunks that can contain matches are read.
+
+        Args:
+            bounds: Array of shape (number of elements, 2) with lower and upper
+                bounds for each element of `key` (e.g. from `collect_rect_bounds`),
+                or `RectangleBounds`.
+            key: Sample variable, which must be in `zonemap_keys`.
+            return_samples: If True, return `Samples` of the matching samples
+                (e.g. to create a dataset with `Samples.get_dataset`).
+
+        Returns:
+            Array of matching indices, or `Samples`.
+        """
+        if key not in self.zonemap_keys:
+            raise KeyError("No zone map for '%s', use enable_zonemaps." % key)
+        bounds = _as_bounds(bounds)
+        low, high = bounds[:, 0], bounds[:, 1]
+        n_chunks = int(math.ceil(len(self) / self.chunk_size))
+        zonemap_min = self.root["meta"]["zonemap_min"][key][:n_chunks]
+        zonemap_max = self.root["meta"]["zonemap_max"][key][:n_chunks]
+        candidates = np.flatnonzero(
+            np.all(zonemap_max >= low, axis=1) & np.all(zonemap_min <= high, axis=1)
+        )
+        sim_status = self.root["meta"]["sim_status"]
+        idx = []
+        for c in candidates:
+            i0 = c * self.chunk_size
+            i1 = min(i0 + self.chunk_size, len(self))
+            values = self.data[key][i0:i1].reshape(i1 - i0, -1)
+            mask = np.all((values >= low) & (values <= high), axis=1)
+            mask &= sim_status[i0:i1] == 1
+            idx.append(np.flatnonzero(mask) + i0)
+        idx = np.concatenate(idx) if idx else np.zeros(0, dtype=int)
+        if return_samples:
+            return Samples(
+                {k: v.get_orthogonal_selection((idx,)) for k, v in self.data.items()}
+            )
+        return idx
 
-        return num_sims
+    def benchmark(self, keys=None):
+        """Measure compression ratio and read throughput of stored arrays.
 
-    def get_dataset(self, idx_range=None, on_after_load_sample=None):
+        Args:
+            keys: Sample variables to benchmark, defaults to all.
+
+        Returns:
+            Dictionary with `nbytes`, `nbytes_stored`, `ratio` and `read_mb_s`
+            (decoded megabytes per second, reading chunk by chunk) per variable.
+        """
+        keys = self.keys() if keys is None else keys
+        results = {}
+        for k in keys:
+            array = self.data[k]
+            t0 = time.perf_counter()
+            for i in range(0, len(array), self.chunk_size):
+                array[i : i + self.chunk_size]
+            dt = time.perf_counter() - t0
+            results[k] = dict(
+                nbytes=array.nbytes,
+                nbytes_stored=array.nbytes_stored,
+                ratio=array.nbytes / array.nbytes_stored,
+                read_mb_s=array.nbytes / 2**20 / max(dt, 1e-9),
+            )
+        return results
+
+    def get_dataset(
+        self, idx_range=None, on_after_load_sample=None, indices=None, **kwargs
+    ):
+        """Returns `ZarrStoreIterableDataset`; keyword arguments are passed on."""
         return ZarrStoreIterableDataset(
-            self, idx_range=idx_range, on_after_load_sample=on_after_load_sample
+            self,
+            idx_range=idx_range,
+            on_after_load_sample=on_after_load_sample,
+            indices=indices,
+            **kwargs,
+        )
+
+    def get_dataloader(
+        self,
+        num_workers=0,
+        batch_size=1,
+        pin_memory=False,
+        drop_last=True,
+        idx_range=None,
+        on_after_load_sample=None,
+        on_after_load_batch=None,
+        batched=False,
+        **kwargs,
+    ):
+        """Returns DataLoader for the store.
+
+        Args:
+            batched: If True, the dataset yields ready-made minibatches, which
+                are passed through the DataLoader with `batch_size=None`.
+                `on_after_load_batch` is then applied in the dataset.
+            **kwargs: Passed on to `ZarrStoreIterableDataset`, e.g. `prefetch`.
+        """
+        if batched:
+            ds = self.get_dataset(
+                idx_range=idx_range,
+                on_after_load_sample=on_after_load_sample,
+                batch_size=batch_size,
+                on_after_load_batch=on_after_load_batch,
+                drop_last=drop_last,
+                **kwargs,
+            )
+            return torch.utils.data.DataLoader(
+                ds,
+                num_workers=num_workers,
+                batch_size=None,
+                pin_memory=pin_memory,
+            )
+        ds = self.get_dataset(
+            idx_range=idx_range, on_after_load_sample=on_after_load_sample, **kwargs
+        )
+        dl = torch.utils.data.DataLoader(
+            ds,
+            num_workers=num_workers,
+            batch_size=batch_size,
+            drop_last=drop_last,
+            pin_memory=pin_memory,
+            collate_fn=get_collate_fn(on_after_load_batch),
+        )
+        return dl
+
+
+#############
+# MemmapStore
+#############
+
+
+class MemmapStore:
+    r"""Storing training data in raw memory-mapped `.npy` files.
+
+    Alternative to `ZarrStore` for stores that fit on fast local disks.  Data
+    is stored uncompressed, with one `.npy` file per sample variable, and read
+    via memory maps.  Datasets return `torch.from_numpy` views into the memory
+    maps, without copies or decompression.
+
+    The status of each slot is kept in `sim_status.npy`: 0 for pending, 1 for
+    done, and negative values for leased slots, storing minus the lease
+    deadline (in seconds since the epoch).
+
+    Args:
+        file_path: Store directory.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.lock = fasteners.InterProcessLock(file_path + ".lock.file")
+        self._arrays = None
+
+    def __getstate__(self):
+        # Memory maps and locks are re-opened in worker processes
+        state = self.__dict__.copy()
+        state["_arrays"] = None
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = fasteners.InterProcessLock(self.file_path + ".lock.file")
+
+    def init(self, N, chunk_size, shapes=None, dtypes=None, seed=None):
+        """Initialize store.
+
+        Args:
+            N: Number of samples.
+            chunk_size: Default number of samples per simulation batch.
+            shapes, dtypes: Dictionaries with shapes and dtypes of all sample variables.
+            seed: Optional integer seed, see `ZarrStore.init`.
+        """
+        if len(self) > 0:
+            print("WARNING: Already initialized.")
+            return self
+        os.makedirs(self.file_path, exist_ok=True)
+        for k in shapes.keys():
+            np.lib.format.open_memmap(
+                self._filename(k), mode="w+", dtype=dtypes[k], shape=(N, *shapes[k])
+            )
+        np.lib.format.open_memmap(
+            self._filename("sim_status"), mode="w+", dtype="i8", shape=(N,)
+        )
+        meta = dict(keys=list(shapes.keys()), chunk_size=chunk_size, seed=seed)
+        with open(os.path.join(self.file_path, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        self._arrays = None
+        return self
+
+    def _filename(self, key):
+        return os.path.join(self.file_path, key + ".npy")
+
+    @property
+    def meta(self):
+        with open(os.path.join(self.file_path, "meta.json")) as f:
+            return json.load(f)
+
+    @property
+    def arrays(self):
+        """Dictionary of memory-mapped arrays, including `sim_status`."""
+        if self._arrays is None:
+            keys = self.meta["keys"] + ["sim_status"]
+            self._arrays = {k: np.load(self._filename(k), mmap_mode="r+") for k in keys}
+        return self._arrays
+
+    @property
+    def data(self):
+        return {k: v for k, v in self.arrays.items() if k != "sim_status"}
+
+    @property
+    def chunk_size(self):
+        return self.meta["chunk_size"]
+
+    @property
+    def seed(self):
+        return self.meta["seed"]
+
+    def __len__(self):
+        if not os.path.exists(os.path.join(self.file_path, "meta.json")):
+            return 0
+        return len(self.arrays["sim_status"])
+
+    def keys(self):
+        return list(self.data.keys())
+
+    def __getitem__(self, i):
+        if isinstance(i, int):
+            return {k: v[i] for k, v in self.data.items()}
+        elif isinstance(i, slice):
+            return Samples({k: v[i] for k, v in self.data.items()})
+        elif isinstance(i, str):
+            return self.data[i]
+        else:
+            raise ValueError
+
+    def numpy(self):
+        return {k: np.array(v) for k, v in self.data.items()}
+
+    @property
+    def sims_required(self):
+        return int((self.arrays["sim_status"] != 1).sum())
+
+    def simulate(
+        self,
+        sampler,
+        max_sims=None,
+        batch_size=None,
+        num_workers=0,
+        lease_timeout=3600.0,
+    ):
+        """Run simulations and store results.
+
+        Slots are leased before simulating, such that concurrent processes
+        never duplicate work (see `ZarrStore.simulate`).
+
+        Args:
+            sampler: Simulator instance, or function that takes the number of
+                samples as argument and returns `Samples`.
+            max_sims: Maximum number of simulations to run.
+            batch_size: Number of simulations per batch, defaults to `chunk_size`.
+            num_workers: Number of worker processes used by `Simulator.sample`.
+                The pool is started once and used for all batches.
+            lease_timeout: Lease duration in seconds.
+        """
+        batch_size = self.chunk_size if batch_size is None else batch_size
+        max_sims = len(self) if max_sims is None else max_sims
+        is_simulator = isinstance(sampler, swyft.Simulator)
+        total_sims = 0
+        with _get_executor(sampler, num_workers if is_simulator else 0) as executor:
+            while total_sims < max_sims:
+                lease, idx = self._lease_slots(
+                    min(batch_size, max_sims - total_sims), lease_timeout
+                )
+                if len(idx) == 0:
+                    break
+                if is_simulator:
+                    samples = sampler.sample(
+                        len(idx),
+                        num_workers=num_workers,
+                        seed=self.seed,
+                        indices=idx,
+                        executor=executor,
+                    )
+                else:
+                    samples = sampler(len(idx))
+                self._store_samples(samples, idx, lease)
+                total_sims += len(idx)
+
+    def _lease_slots(self, num_sims, timeout):
+        """Lease up to `num_sims` pending slots for `timeout` seconds.
+
+        Returns:
+            Lease id (the status value of the leased slots) and slot indices.
+        """
+        now = time.time()
+        lease = -int(math.ceil(now + timeout))
+        with self.lock:
+            sim_status = self.arrays["sim_status"]
+            free = (sim_status == 0) | ((sim_status < 0) & (-sim_status < now))
+            idx = np.flatnonzero(free)[:num_sims]
+            sim_status[idx] = lease
+            sim_status.flush()
+        return lease, idx
+
+    def _store_samples(self, samples, idx, lease=None):
+        """Store samples in slots `idx` leased by `lease`, or in pending slots.
+
+        Slots whose lease expired and was taken over by another worker are
+        skipped.  Checking and writing happens under the store lock, such that
+        late writes never overwrite the new owner's slots.
+
+        Returns:
+            Number of stored samples.
+        """
+        idx = np.asarray(idx)
+        with self.lock:
+            sim_status = self.arrays["sim_status"]
+            owned = sim_status[idx] == (0 if lease is None else lease)
+            samples, idx = _take(samples, owned), idx[owned]
+            index_slices = _get_index_slices(idx)
+            for i_slice, j_slice in index_slices:
+                for k, v in self.data.items():
+                    v[j_slice[0] : j_slice[1]] = np.asarray(
+                        samples[k][i_slice[0] : i_slice[1]]
+                    )
+            for v in self.data.values():
+                v.flush()
+            for _, j_slice in index_slices:
+                sim_status[j_slice[0] : j_slice[1]] = 1
+            sim_status.flush()
+        return len(idx)
+
+    def get_dataset(self, idx_range=None, on_after_load_sample=None, indices=None):
+        return MemmapStoreDataset(
+            self,
+            idx_range=idx_range,
+            on_after_load_sample=on_after_load_sample,
+            indices=indices,
         )
 
     def get_dataloader(
@@ -314,6 +1569,7 @@ class ZarrStore:
         drop_last=True,
         idx_range=None,
         on_after_load_sample=None,
+        on_after_load_batch=None,
     ):
         ds = self.get_dataset(
             idx_range=idx_range, on_after_load_sample=on_after_load_sample
@@ -322,42 +1578,595 @@ class ZarrStore:
             ds,
             num_workers=num_workers,
             batch_size=batch_size,
+            shuffle=True,
             drop_last=drop_last,
             pin_memory=pin_memory,
+            collate_fn=get_collate_fn(on_after_load_batch),
         )
         return dl
 
 
+class MemmapStoreDataset(torch.utils.data.Dataset):
+    """Map-style dataset returning zero-copy torch views into a `MemmapStore`."""
+
+    def __init__(
+        self,
+        store: MemmapStore,
+        idx_range=None,
+        on_after_load_sample=None,
+        indices=None,
+    ):
+        self.store = store
+        self.indices = None if indices is None else np.asarray(indices, dtype=int)
+        if self.indices is not None:
+            self.offset = 0
+            self.n_samples = len(self.indices)
+        elif idx_range is None:
+            self.offset = 0
+            self.n_samples = len(store)
+        else:
+            self.offset = idx_range[0]
+            self.n_samples = idx_range[1] - idx_range[0]
+        self.on_after_load_sample = on_after_load_sample
+
+    def __len__(self):
+        return self.n_samples
+
+    def __getitem__(self, i):
+        i = self.offset + i if self.indices is None else int(self.indices[i])
+        out = {k: torch.from_numpy(v[i : i + 1])[0] for k, v in self.store.data.items()}
+        if self.on_after_load_sample:
+            out = self.on_after_load_sample(out)
+        return out
+
+
+###############
+# Codec support
+###############
+
+
+class BFloat16(numcodecs.abc.Codec):
+    """Lossy codec storing float32 arrays as bfloat16 (round to nearest even).
+
+    Keeps the float32 exponent range but only eight bits of mantissa.  Arrays
+    are decoded to float32.
+    """
+
+    codec_id = "swyft_bfloat16"
+
+    def encode(self, buf):
+        a = np.ascontiguousarray(buf, dtype="<f4").view("<u4")
+        rounding = ((a >> 16) & 1) + np.uint32(0x7FFF)
+        return ((a + rounding) >> 16).astype("<u2")
+
+    def decode(self, buf, out=None):
+        a = np.frombuffer(numcodecs.compat.ensure_bytes(buf), dtype="<u2")
+        a = (a.astype("<u4") << 16).view("<f4")
+        return numcodecs.compat.ndarray_copy(a, out)
+
+
+numcodecs.register_codec(BFloat16)
+
+_SHUFFLE = dict(
+    none=numcodecs.Blosc.NOSHUFFLE,
+    byte=numcodecs.Blosc.SHUFFLE,
+    bit=numcodecs.Blosc.BITSHUFFLE,
+)
+
+
+def get_codec_kwargs(
+    sample_dtype,
+    cname="lz4",
+    clevel=5,
+    shuffle="byte",
+    dtype=None,
+    filters=None,
+):
+    """Returns zarr array arguments for given storage settings.
+
+    Args:
+        sample_dtype: Dtype of the sample variable.
+        cname: Blosc compressor, e.g. "lz4", "lz4hc", "zstd" or "zlib".  If
+            None, data is stored uncompressed.
+        clevel: Compression level.
+        shuffle: Blosc shuffle filter, "none", "byte" or "bit".
+        dtype: Optional storage dtype.  "float16" and "bfloat16" store floats
+            lossily, and are decoded to float32 on read.
+        filters: Optional list of additional numcodecs filters.
+
+    Returns:
+        Dictionary with `dtype`, `compressor` and `filters`.
+    """
+    filters = list(filters) if filters is not None else []
+    if dtype in ("float16", "bfloat16"):
+        codec = (
+            numcodecs.AsType(encode_dtype="f2", decode_dtype="f4")
+            if dtype == "float16"
+            else BFloat16()
+        )
+        filters = [codec] + filters
+        dtype = np.dtype("float32")
+    else:
+        dtype = np.dtype(sample_dtype if dtype is None else dtype)
+    compressor = (
+        numcodecs.Blosc(cname=cname, clevel=clevel, shuffle=_SHUFFLE[shuffle])
+        if cname is not None
+        else None
+    )
+    return dict(dtype=dtype, compressor=compressor, filters=filters or None)
+
+
+def benchmark_codecs(samples, candidates, chunk_size=1024, path=None):
+    """Compare storage settings on given samples.
+
+    Args:
+        samples: Samples used for the benchmark.
+        candidates: Dictionary of named `codecs` arguments for `ZarrStore.init`.
+        chunk_size: Chunk size of the benchmark stores.
+        path: Directory for the temporary stores, defaults to a temporary directory.
+
+    Returns:
+        Dictionary with the `ZarrStore.benchmark` results for each candidate.
+    """
+    shapes = {k: v.shape[1:] for k, v in samples.items()}
+    dtypes = {k: np.asarray(v[:1]).dtype for k, v in samples.items()}
+    idx = np.arange(len(samples))
+    results = {}
+    with tempfile.TemporaryDirectory(dir=path) as tmpdir:
+        for name, codecs in candidates.items():
+            file_path = os.path.join(tmpdir, "%s.zarr" % name)
+            store = ZarrStore(file_path, sync_path=False)
+            store.init(len(samples), chunk_size, shapes, dtypes, codecs=codecs)
+            store._store_samples(samples, idx)
+            results[name] = store.benchmark()
+    return results
+
+
+def _as_bounds(bounds):
+    """Returns rectangular bounds as numpy array of shape (number of parameters, 2)."""
+    if isinstance(bounds, swyft.RectangleBounds):
+        bounds = bounds.bounds
+    if isinstance(bounds, torch.Tensor):
+        bounds = bounds.cpu().numpy()
+    return np.array(bounds, dtype=float).reshape(-1, 2)
+
+
+def _in_bounds(values, bounds):
+    """Mask of rows of `values` (shape (N, number of parameters)) inside `bounds`."""
+    return np.all((values >= bounds[:, 0]) & (values <= bounds[:, 1]), axis=1)
+
+
+class _TruncatedPrior:
+    """Draws conditions `{key: z}` from the prior truncated to `bounds`.
+
+    Draws inside the optional box `exclude` are rejected.
+    """
+
+    def __init__(self, prior, bounds, key, exclude=None):
+        self.sampler = swyft.RectBoundSampler(prior, bounds=bounds)
+        self.key = key
+        self.exclude = exclude
+
+    def __call__(self):
+        while True:
+            z = self.sampler()
+            if (
+                self.exclude is None
+                or not _in_bounds(z.reshape(1, -1), self.exclude)[0]
+            ):
+                return {self.key: z}
+
+
+def _expand_slices(slices):
+    """Returns indices covered by a list of [start, stop] slot ranges."""
+    if not slices:
+        return np.zeros(0, dtype=int)
+    return np.concatenate([np.arange(j0, j1) for j0, j1 in slices])
+
+
+def _take(samples, mask):
+    """Returns samples (dict of arrays) at positions where `mask` is True."""
+    if mask.all():
+        return samples
+    pos = np.flatnonzero(mask)
+    return {k: np.asarray(v)[pos] for k, v in samples.items()}
+
+
+def _get_executor(simulator, num_workers):
+    """Returns worker pool of `simulator`, or a null context if `num_workers` is 0."""
+    if num_workers > 0:
+        return simulator.get_executor(num_workers)
+    return contextlib.nullcontext()
+
+
+def _roundtrip(array, values):
+    """Returns `values` as read back after storing them in zarr `array`.
+
+    Lossy storage (e.g. "float16" or "bfloat16", see `get_codec_kwargs`)
+    changes the values, which matters for statistics like zone maps.
+    """
+    values = np.ascontiguousarray(values, dtype=array.dtype)
+    if not array.filters:
+        return values
+    buf = values
+    for codec in array.filters:
+        buf = codec.encode(buf)
+    for codec in reversed(array.filters):
+        buf = codec.decode(buf)
+    return numcodecs.compat.ensure_ndarray(buf).view(array.dtype).reshape(values.shape)
+
+
 def _get_index_slices(idx):
     """Returns list of enumerated consecutive indices"""
-    idx = np.array(idx)
-    pointer = 0
-    residual_idx = idx
-    slices = []
-    while len(residual_idx) > 0:
-        mask = residual_idx - residual_idx[0] - np.arange(len(residual_idx)) == 0
-        slc1 = [residual_idx[mask][0], residual_idx[mask][-1] + 1]
-        slc2 = [pointer, pointer + sum(mask)]
-        pointer += sum(mask)
-        slices.append([slc2, slc1])
-        residual_idx = residual_idx[~mask]
-    return slices
+    idx = np.asarray(idx, dtype=int)
+    if len(idx) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(idx) != 1) + 1
+    starts = np.concatenate([[0], breaks])
+    stops = np.concatenate([breaks, [len(idx)]])
+    return [
+        [[int(i0), int(i1)], [int(idx[i0]), int(idx[i1 - 1]) + 1]]
+        for i0, i1 in zip(starts, stops)
+    ]
+
+
+class ChunkCache:
+    """Cache of decompressed store chunks, see `ZarrStore.enable_chunk_cache`.
+
+    Wraps a `MemoryCache` or `DiskCache`.  Hit and miss counters are those of
+    the wrapped cache, which for a `DiskCache` include all processes sharing it.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def put(self, key, value):
+        self.cache.put(key, value)
+
+    def clear(self):
+        """Remove all cached chunks and reset counters."""
+        self.cache.clear()
+
+    def stats(self):
+        """Returns dictionary with hit/miss counters and size information."""
+        stats = self.cache.stats()
+        stats["hit_rate"] = stats["hits"] / max(stats["hits"] + stats["misses"], 1)
+        return stats
+
+
+class _StagingStore(MutableMapping):
+    """Wraps a zarr `DirectoryStore`, keeping written values in memory.
+
+    Used to encode chunks without writing them to the store, see
+    `ZarrStore._store_samples`.  Deleted keys are staged as None.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.staged = {}
+
+    def __getitem__(self, key):
+        if key not in self.staged:
+            return self.store[key]
+        if self.staged[key] is None:
+            raise KeyError(key)
+        return self.staged[key]
+
+    def __setitem__(self, key, value):
+        self.staged[key] = value
+
+    def __delitem__(self, key):
+        self.staged[key] = None
+
+    def __iter__(self):
+        return iter(self.store)
+
+    def __len__(self):
+        return len(self.store)
+
+    def to_files(self):
+        """Writes staged values to temporary files next to their destination.
+
+        Returns:
+            List of destination paths and temporary paths (None for deleted keys).
+        """
+        files = []
+        for key, value in self.staged.items():
+            path = os.path.join(self.store.path, key)
+            temp_path = None
+            if value is not None:
+                temp_path = "%s.%s.partial" % (path, uuid.uuid4().hex)
+                with open(temp_path, "wb") as f:
+                    f.write(numcodecs.compat.ensure_bytes(value))
+            files.append((path, temp_path))
+        return files
+
+    @staticmethod
+    def publish(files):
+        """Moves temporary files written by `to_files` into place."""
+        for path, temp_path in files:
+            if temp_path is not None:
+                os.replace(temp_path, path)
+            elif os.path.exists(path):
+                os.remove(path)
+
+    @staticmethod
+    def discard(files):
+        """Removes temporary files written by `to_files`, unless already removed."""
+        for _, temp_path in files:
+            if temp_path is not None:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(temp_path)
+
+
+class _ChunkWriteBuffer:
+    """Collects samples per store chunk, such that only whole chunks are written.
+
+    Writing partially covered chunks requires zarr to read, decompress and
+    recompress them, once per key and write.  Chunks are hence kept in memory
+    until all of their leased slots (see `expect`) are simulated, and written
+    in a single aligned write.  Remaining partial chunks are written by `flush`.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.chunks = {}  # chunk index -> [arrays, filled mask, lease ids, expected]
+
+    def _get(self, c, expected):
+        if c not in self.chunks:
+            data = self.store.data
+            chunk_size = self.store.chunk_size
+            n = min(chunk_size, self.store.capacity - c * chunk_size)
+            arrays = {
+                k: np.empty((n, *v.shape[1:]), dtype=v.dtype) for k, v in data.items()
+            }
+            self.chunks[c] = [arrays, np.zeros(n, dtype=bool), set(), expected]
+        return self.chunks[c]
+
+    def expect(self, idx):
+        """Registers leased slots `idx`, chunks are complete once all are added."""
+        chunks, counts = np.unique(
+            np.asarray(idx) // self.store.chunk_size, return_counts=True
+        )
+        for c, n in zip(chunks, counts):
+            self._get(c, 0)[3] += n
+
+    def add(self, samples, idx, lease=None):
+        """Adds samples for slots `idx`, leased by lease id (or list of ids) `lease`."""
+        chunk_size = self.store.chunk_size
+        idx = np.asarray(idx)
+        chunk_ids = idx // chunk_size
+        complete = []
+        for c in np.unique(chunk_ids):
+            arrays, mask, leases, expected = self._get(c, chunk_size)
+            sel = np.flatnonzero(chunk_ids == c)
+            pos = idx[sel] - c * chunk_size
+            for k, v in arrays.items():
+                v[pos] = np.asarray(samples[k][sel])
+            mask[pos] = True
+            if isinstance(lease, str):
+                leases.add(lease)
+            elif lease is not None:
+                leases.update(lease)
+            if mask.all() or mask.sum() >= expected:
+                complete.append(c)
+        for c in complete:
+            self._write(c)
+
+    def _write(self, c):
+        arrays, mask, leases, _ = self.chunks.pop(c)
+        pos = np.flatnonzero(mask)
+        if not mask.all():
+            arrays = {k: v[pos] for k, v in arrays.items()}
+        self.store._store_samples(
+            arrays, pos + c * self.store.chunk_size, sorted(leases)
+        )
+
+    def flush(self):
+        for c in sorted(self.chunks):
+            self._write(c)
+
+
+def _prefetch(iterable, depth):
+    """Iterate over `iterable` in a background thread, reading up to `depth` items ahead."""
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+            put(done)
+        except BaseException as e:  # Re-raised by the consumer
+            put(e)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def _shuffle_chunks(chunks, n_chunks):
+    """Mix samples across chunks, using a shuffle buffer that holds `n_chunks` chunks.
+
+    Yields blocks of randomly drawn samples, one block per input chunk.  The
+    buffer is allocated once; drawn samples are replaced by samples from the
+    end of the buffer, such that each sample is copied at most three times.
+    """
+    buffer = None
+    fill = 0
+    sizes = []
+    for chunk in chunks:
+        n = len(next(iter(chunk.values())))
+        if buffer is None:
+            buffer = {
+                k: np.empty((n_chunks * n, *v.shape[1:]), dtype=v.dtype)
+                for k, v in chunk.items()
+            }
+        capacity = len(next(iter(buffer.values())))
+        if fill + n > capacity:  # Chunks larger than the first one
+            buffer = {
+                k: np.concatenate([v[:fill], np.empty((n, *v.shape[1:]), v.dtype)])
+                for k, v in buffer.items()
+            }
+        for k, v in chunk.items():
+            buffer[k][fill : fill + n] = v
+        fill += n
+        sizes.append(n)
+        if len(sizes) < n_chunks:
+            continue
+        n = sizes.pop(0)
+        pos = np.random.permutation(fill)[:n]
+        yield {k: v[pos] for k, v in buffer.items()}
+        # Fill the holes with the remaining samples from the end of the buffer
+        tail = np.arange(fill - n, fill)
+        holes = pos[pos < fill - n]
+        moved = tail[~np.isin(tail, pos)]
+        for v in buffer.values():
+            v[holes] = v[moved]
+        fill -= n
+    if sizes:
+        perm = np.random.permutation(fill)
+        for n in sizes:
+            yield {k: v[perm[:n]] for k, v in buffer.items()}
+            perm = perm[n:]
 
 
 class ZarrStoreIterableDataset(torch.utils.data.dataloader.IterableDataset):
+    """Iterable dataset reading a `ZarrStore` chunk by chunk.
+
+    Args:
+        zarr_store: ZarrStore instance.
+        idx_range: Optional range `(start, stop)` of samples.
+        indices: Alternatively, optional array of sample indices (e.g. from
+            `ZarrStore.simulate(..., bounds=...)` or `ZarrStore.select`).
+            Chunks are still read as a whole, and then subselected.
+        on_after_load_sample: Callable, that is applied to individual samples.
+        batch_size: If not None, yield shuffled minibatch dicts, sliced
+            directly from the chunk arrays, instead of individual samples.
+            Use with `DataLoader(..., batch_size=None)`.
+        on_after_load_batch: Callable, that is applied to minibatches in
+            batched mode.
+        drop_last: Drop last incomplete minibatch in batched mode.
+        prefetch: Number of chunks that are read ahead by a background
+            thread.  If zero, chunks are read synchronously.
+        read_threads: If larger than zero, the arrays of each chunk are read
+            in parallel by a pool of threads (numcodecs releases the GIL while
+            decompressing).
+        shuffle_chunks: Number of chunks held in a shuffle buffer, from which
+            samples are drawn across chunk boundaries.  Large chunks can then
+            be used without correlated minibatches.
+        shuffle_buffer_bytes: Alternatively, memory budget of the shuffle
+            buffer in bytes, from which the number of chunks is derived.
+        rank, world_size: Process rank and number of processes for distributed
+            training.  Default to the values of the initialized
+            `torch.distributed` process group, or to 0 and 1.  Chunks are
+            sharded across ranks, and then across DataLoader workers.  Each
+            rank reads `floor(number of samples / world_size)` samples.
+        seed: Seed of the chunk permutation, which is derived from `(seed,
+            epoch)` such that all ranks agree.  Defaults to 0 for distributed
+            training, and to the global numpy random state otherwise.  Call
+            `set_epoch` at the start of each epoch.
+    """
+
     def __init__(
-        self, zarr_store: ZarrStore, idx_range=None, on_after_load_sample=None
+        self,
+        zarr_store: ZarrStore,
+        idx_range=None,
+        on_after_load_sample=None,
+        indices=None,
+        batch_size=None,
+        on_after_load_batch=None,
+        drop_last=False,
+        prefetch=0,
+        read_threads=0,
+        shuffle_chunks=1,
+        shuffle_buffer_bytes=None,
+        rank=None,
+        world_size=None,
+        seed=None,
     ):
         self.zs = zarr_store
-        if idx_range is None:
-            self.n_samples = len(self.zs)
+        self.chunk_size = self.zs.chunk_size
+        if indices is not None:
+            if idx_range is not None:
+                raise ValueError("Provide either idx_range or indices, not both.")
+            self.indices = np.unique(np.asarray(indices, dtype=int))
+            self.n_samples = len(self.indices)
             self.offset = 0
+            # Store chunks with selected samples, and their first position in `indices`
+            self._chunk_ids, self._starts, self._sizes = np.unique(
+                self.indices // self.chunk_size, return_index=True, return_counts=True
+            )
+            self.n_chunks = len(self._chunk_ids)
         else:
-            self.offset = idx_range[0]
-            self.n_samples = idx_range[1] - idx_range[0]
-        self.chunk_size = self.zs.chunk_size
-        self.n_chunks = int(math.ceil(self.n_samples / float(self.chunk_size)))
+            self.indices = None
+            if idx_range is None:
+                self.n_samples = len(self.zs)
+                self.offset = 0
+            else:
+                self.offset = idx_range[0]
+                self.n_samples = idx_range[1] - idx_range[0]
+            self.n_chunks = int(math.ceil(self.n_samples / float(self.chunk_size)))
+            self._sizes = np.minimum(
+                self.chunk_size,
+                self.n_samples - np.arange(self.n_chunks) * self.chunk_size,
+            )
         self.on_after_load_sample = on_after_load_sample
+        if batch_size is not None and on_after_load_sample is not None:
+            raise ValueError(
+                "on_after_load_sample is not supported in batched mode, use on_after_load_batch."
+            )
+        self.batch_size = batch_size
+        self.on_after_load_batch = on_after_load_batch
+        self.drop_last = drop_last
+        self.prefetch = prefetch
+        self.read_threads = read_threads
+        if shuffle_buffer_bytes is not None:
+            chunk_bytes = sum(
+                v.dtype.itemsize * np.prod(v.shape[1:], dtype=int) * self.chunk_size
+                for v in self.zs.data.values()
+            )
+            shuffle_chunks = max(1, int(shuffle_buffer_bytes // chunk_bytes))
+        self.shuffle_chunks = shuffle_chunks
+        distributed = (
+            torch.distributed.is_available() and torch.distributed.is_initialized()
+        )
+        if world_size is None:
+            world_size = torch.distributed.get_world_size() if distributed else 1
+        if rank is None:
+            rank = torch.distributed.get_rank() if distributed else 0
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = 0 if seed is None and world_size > 1 else seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        """Set epoch, which determines the chunk permutation if seeded."""
+        self.epoch = epoch
 
     @staticmethod
     def get_idx(n_chunks, worker_info):
@@ -374,18 +2183,89 @@ class ZarrStoreIterableDataset(torch.utils.data.dataloader.IterableDataset):
             idx = np.random.permutation(n_chunks)
         return idx
 
-    def __iter__(self):
+    def get_shard(self, worker_info):
+        """Returns list of `(chunk index, number of samples)` read by this rank and worker."""
+        sizes = self._sizes
+        if self.seed is None and self.world_size == 1:
+            return [(i, sizes[i]) for i in self.get_idx(self.n_chunks, worker_info)]
+
+        rng = np.random.default_rng([self.seed, self.epoch])
+        perm = rng.permutation(self.n_chunks)
+        # Every rank reads the same number of samples: chunks of its shard are
+        # truncated, or padded with repeated chunks, to fill the quota
+        quota = int(sizes.sum()) // self.world_size
+        shard = []
+        chunks = itertools.chain(
+            perm[self.rank :: self.world_size], itertools.cycle(perm)
+        )
+        while quota > 0:
+            i = next(chunks)
+            shard.append((i, min(sizes[i], quota)))
+            quota -= shard[-1][1]
+        if worker_info is not None:
+            shard = shard[worker_info.id :: worker_info.num_workers]
+        return shard
+
+    def _read_chunk(self, i0, executor=None, n=None, tag=""):
+        if self.indices is not None:
+            j0 = self._starts[i0]
+            sel = self.indices[j0 : j0 + (self._sizes[i0] if n is None else n)]
+            start = self._chunk_ids[i0] * self.chunk_size
+            stop = min(start + self.chunk_size, len(self.zs))
+            data_chunk = self._read_range(start, stop, executor, tag)
+            return {k: v[sel - start] for k, v in data_chunk.items()}
+        start = self.offset + i0 * self.chunk_size
+        stop = self.offset + min((i0 + 1) * self.chunk_size, self.n_samples)
+        if n is not None:
+            stop = min(stop, start + n)
+        return self._read_range(start, stop, executor, tag)
+
+    def _read_range(self, start, stop, executor=None, tag=""):
+        data = self.zs.data
+        keys = list(data.keys())
+        cache = self.zs.chunk_cache
+        if cache is not None:
+            key = "%s:%i:%i" % (tag, start, stop)
+            try:
+                return dict(zip(keys, cache.get(key)))
+            except KeyError:
+                pass
+        if executor is None:
+            arrays = [data[k][start:stop] for k in keys]
+        else:
+            arrays = list(executor.map(lambda k: data[k][start:stop], keys))
+        if cache is not None:
+            cache.put(key, tuple(arrays))
+        return dict(zip(keys, arrays))
+
+    def _iter_chunks(self):
         worker_info = torch.utils.data.get_worker_info()
-        idx = self.get_idx(self.n_chunks, worker_info)
-        offset = self.offset
-        for i0 in idx:
-            # Read in chunks
-            data_chunk = {}
-            for k in self.zs.data.keys():
-                data_chunk[k] = self.zs.data[k][
-                    offset + i0 * self.chunk_size : offset + (i0 + 1) * self.chunk_size
-                ]
-            n = len(data_chunk[k])
+        shard = self.get_shard(worker_info)
+        executor = (
+            ThreadPoolExecutor(max_workers=self.read_threads)
+            if self.read_threads > 0
+            else None
+        )
+        tag = self.zs._get_cache_tag() if self.zs.chunk_cache is not None else ""
+        chunks = (self._read_chunk(i0, executor, n, tag) for i0, n in shard)
+        if self.prefetch > 0:
+            chunks = _prefetch(chunks, self.prefetch)
+        try:
+            if self.shuffle_chunks > 1:
+                yield from _shuffle_chunks(chunks, self.shuffle_chunks)
+            else:
+                yield from chunks
+        finally:
+            chunks.close()
+            if executor is not None:
+                executor.shutdown()
+
+    def __iter__(self):
+        if self.batch_size is not None:
+            yield from self._iter_batches()
+            return
+        for data_chunk in self._iter_chunks():
+            n = len(next(iter(data_chunk.values())))
 
             # Return separate samples
             for i in np.random.permutation(n):
@@ -394,6 +2274,30 @@ class ZarrStoreIterableDataset(torch.utils.data.dataloader.IterableDataset):
                     out = self.on_after_load_sample(out)
                 yield out
 
+    def _iter_batches(self):
+        batch_size = self.batch_size
+        residual = None  # Leftover samples, carried over to the next chunk
+        for data_chunk in self._iter_chunks():
+            if residual is not None:
+                data_chunk = {
+                    k: np.concatenate([residual[k], v]) for k, v in data_chunk.items()
+                }
+            n = len(next(iter(data_chunk.values())))
+            perm = np.random.permutation(n)
+            n_full = n - n % batch_size
+            for i in range(0, n_full, batch_size):
+                yield self._get_batch(data_chunk, perm[i : i + batch_size])
+            residual = {k: v[perm[n_full:]] for k, v in data_chunk.items()}
+        if residual is not None and not self.drop_last:
+            if len(next(iter(residual.values()))) > 0:
+                yield self._get_batch(residual, slice(None))
+
+    def _get_batch(self, data_chunk, idx):
+        batch = {k: v[idx] for k, v in data_chunk.items()}
+        if self.on_after_load_batch is not None:
+            batch = self.on_after_load_batch(batch)
+        return batch
+
 
 # def get_ntrain_nvalid(
 #    validation_amount: Union[float, int], len_dataset: int
@@ -1,4 +1,13 @@
+import asyncio
+import contextlib
+import hashlib
+import inspect
+import json
+import math
+import time
 from abc import abstractmethod
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from typing import (
     Callable,
     Dict,
@@ -17,7 +26,12 @@ import swyft
 import swyft.lightning.data
 from swyft.lightning.data import *
 from swyft.lightning.utils import collate_output
-
+from swyft.lightning.cache import (
+    MemoryCache,
+    CachedFunction,
+    AsyncCachedFunction,
+    _nbytes,
+)
 
 #########
 # Samples
@@ -75,6 +89,7 @@ class Samples(dict):
         on_after_load_sample=None,
         repeat=None,
         num_workers=0,
+        on_after_load_batch=None,
     ):
         """Generator function to directly generate a dataloader object.
 
@@ -83,12 +98,17 @@ class Samples(dict):
             shuffle: shuffle for dataloader
             on_after_load_sample: see `get_dataset`
             repeat: If not None, Wrap dataset in RepeatDatasetWrapper
+            on_after_load_batch: Callable, that is applied to collated minibatches on the fly (e.g. `BatchedSimulatorResampler`).
         """
         dataset = self.get_dataset(on_after_load_sample=on_after_load_sample)
         if repeat is not None:
             dataset = swyft.lightning.data.RepeatDatasetWrapper(dataset, repeat=repeat)
         return torch.utils.data.DataLoader(
-            dataset, batch_size=batch_size, shuffle=shuffle, num_workers=num_workers
+            dataset,
+            batch_size=batch_size,
+            shuffle=shuffle,
+            num_workers=num_workers,
+            collate_fn=swyft.lightning.data.get_collate_fn(on_after_load_batch),
         )
 
 
@@ -97,10 +117,117 @@ class Samples(dict):
 #######
 
 
+def _collate(values):
+    """Stack list of tensors/arrays along a new leading batch dimension."""
+    if isinstance(values[0], torch.Tensor):
+        return torch.stack(values)
+    else:
+        return np.stack(values)
+
+
+def _call_per_sample(fn, args, sliced, N, multiple_outputs, seeder=None):
+    """Call per-sample function `fn` on a batch of `N` samples.
+
+    Arguments flagged in `sliced` are sliced along the leading batch dimension,
+    all other arguments are passed as they are.  If a `CounterSeeder` is
+    provided, its sample index is updated before each call.
+    """
+    results = []
+    for i in range(N):
+        if seeder is not None:
+            seeder.index = int(seeder.indices[i])
+        results.append(fn(*(a[i] if s else a for a, s in zip(args, sliced))))
+    return _collate_results(results, multiple_outputs)
+
+
+async def _acall_per_sample(fn, args, sliced, N, multiple_outputs, seeder=None):
+    """Asynchronous version of `_call_per_sample`, awaiting all samples concurrently."""
+    coroutines = []
+    for i in range(N):
+        if seeder is not None:
+            seeder.index = int(seeder.indices[i])
+        coroutines.append(fn(*(a[i] if s else a for a, s in zip(args, sliced))))
+    results = await asyncio.gather(*coroutines)
+    return _collate_results(results, multiple_outputs)
+
+
+def _call_vectorized(fn, args, N, pass_batch_size, seeder=None):
+    """Call vectorized function `fn`; seeding uses the index of the first sample.
+
+    If `pass_batch_size` is True, the batch size is passed as keyword argument `batch_size`.
+    """
+    if seeder is not None:
+        seeder.index = int(seeder.indices[0])
+    if pass_batch_size:
+        return fn(*args, batch_size=N)
+    return fn(*args)
+
+
+def _check_batch(result, N, name, multiple_outputs):
+    """Raises ValueError if outputs of a vectorized node are not batches of `N` samples."""
+    for value in result if multiple_outputs else (result,):
+        n = len(value) if hasattr(value, "__len__") and np.ndim(value) > 0 else None
+        if n != N:
+            raise ValueError(
+                "Vectorized node '%s' returned %s samples instead of %i.  "
+                "Vectorized functions receive the batch size as keyword "
+                "argument `batch_size` if registered with "
+                "`pass_batch_size=True`." % (name, n, N)
+            )
+
+
+def _collate_results(results, multiple_outputs):
+    if multiple_outputs:
+        return tuple(_collate(list(r)) for r in zip(*results))
+    else:
+        return _collate(results)
+
+
+def _is_async(fn):
+    """True for coroutine functions, and callables with a coroutine `__call__` method."""
+    return inspect.iscoroutinefunction(fn) or inspect.iscoroutinefunction(
+        getattr(fn, "__call__", None)
+    )
+
+
+def _run_coroutine(coroutine):
+    """Runs `coroutine` to completion and returns its result.
+
+    If called from a running event loop (e.g. in Jupyter), the coroutine is
+    run on a new event loop in a helper thread, since `asyncio.run` cannot be
+    nested.  Use `Simulator.asample` to sample on the running loop instead.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+
+def _run_sync(fn):
+    """Turn coroutine function into a blocking function."""
+
+    def wrapped(*args, **kwargs):
+        return _run_coroutine(fn(*args, **kwargs))
+
+    return wrapped
+
+
 class Node:
     """Provides lazy evaluation functionality."""
 
-    def __init__(self, parname, mult_parnames, fn, *inputs):
+    def __init__(
+        self,
+        parname,
+        mult_parnames,
+        fn,
+        *inputs,
+        vectorized=False,
+        rng=False,
+        seed_torch=False,
+        pass_batch_size=False,
+    ):
         """Instantiates LazyValue object.
 
         Args:
@@ -109,26 +236,86 @@ class Node:
             fn_out_names: Name or list of names of variables that `fn` returns.
             fn: Callable that returns sample or list of samples.
             args, kwargs: Arguments and keyword arguments provided to `fn` upon evaluation.
+            vectorized: If True, `fn` operates on batches of samples with a leading batch dimension.
+            rng: If True, `fn` receives a `numpy.random.Generator` as keyword argument `rng`.
+            seed_torch: If True, the global torch random state is seeded before seeded calls.
+            pass_batch_size: If True, vectorized calls of `fn` receive the batch size as keyword argument `batch_size`.
         """
         self._parname = parname
         self._mult_parnames = mult_parnames
         self._fn = fn
         self._inputs = inputs
+        self._vectorized = vectorized
+        self._pass_batch_size = vectorized and pass_batch_size
+        self._rng = rng
+        self._seed_torch = seed_torch
+        self._is_async = _is_async(fn)
 
     def __repr__(self):
         return f"Node{self._parname, self._fn, self._inputs}"
 
-    def evaluate(self, trace):
+    @property
+    def _name(self):
+        if self._mult_parnames is None:
+            return self._parname
+        return ",".join(self._mult_parnames)
+
+    def _get_fn(self, profiler, sync=False, seeder=None):
+        fn = self._fn
+        name = self._name
+        if self._rng or seeder is not None:
+            fn = SeededFunction(fn, name, seeder, self._rng, self._seed_torch)
+        if profiler is not None:
+            if self._is_async:
+                fn = AsyncProfiledFunction(fn, name, profiler)
+            else:
+                fn = ProfiledFunction(fn, name, profiler)
+        if sync and self._is_async:
+            fn = _run_sync(fn)
+        return fn
+
+    def evaluate(self, trace, profiler=None, seeder=None):
         if self._parname in trace.keys():  # Nothing to do
             return trace[self._parname]
         else:
             args = (
-                arg.evaluate(trace)
+                arg.evaluate(trace, profiler, seeder)
                 if (isinstance(arg, Node) or isinstance(arg, Switch))
                 else arg
                 for arg in self._inputs
             )
-            result = self._fn(*args)
+            result = self._get_fn(profiler, sync=True, seeder=seeder)(*args)
+            if self._mult_parnames is None:
+                trace[self._parname] = result
+            else:
+                for parname, value in zip(self._mult_parnames, result):
+                    trace[parname] = value
+            return trace[self._parname]
+
+    def evaluate_batch(self, trace, N, profiler=None, seeder=None):
+        """Evaluates node for a batch of `N` samples.
+
+        Per-sample nodes are called once for each sample, with node inputs
+        sliced along the leading batch dimension, and their outputs are
+        stacked.  Vectorized nodes are called once for the entire batch.
+        """
+        if self._parname in trace.keys():  # Nothing to do
+            return trace[self._parname]
+        else:
+            is_node = [isinstance(arg, (Node, Switch)) for arg in self._inputs]
+            args = [
+                arg.evaluate_batch(trace, N, profiler, seeder) if b else arg
+                for arg, b in zip(self._inputs, is_node)
+            ]
+            fn = self._get_fn(profiler, sync=True, seeder=seeder)
+            multiple_outputs = self._mult_parnames is not None
+            if self._vectorized:
+                result = _call_vectorized(fn, args, N, self._pass_batch_size, seeder)
+                _check_batch(result, N, self._name, multiple_outputs)
+            else:
+                result = _call_per_sample(
+                    fn, args, is_node, N, multiple_outputs, seeder
+                )
             if self._mult_parnames is None:
                 trace[self._parname] = result
             else:
@@ -145,23 +332,228 @@ class Switch:
         self._options = options
         self._choice = choice
 
-    def evaluate(self, trace):
+    def evaluate(self, trace, profiler=None, seeder=None):
         if self._parname in trace.keys():  # Nothing to do
             return trace[self._parname]
         else:
-            choice = self._choice.evaluate(trace)
+            choice = self._choice.evaluate(trace, profiler, seeder)
             choice = int(choice)  # type-cast if possible
-            result = self._options[choice].evaluate(trace)
+            t0 = time.perf_counter()
+            result = self._options[choice].evaluate(trace, profiler, seeder)
+            trace[self._parname] = result
+            if profiler is not None:
+                profiler.record(self._parname, time.perf_counter() - t0, result)
+            return result
+
+    def evaluate_batch(self, trace, N, profiler=None, seeder=None):
+        """Evaluates switch for a batch of `N` samples.
+
+        All options that are selected by at least one sample are evaluated for
+        the full batch, and the output is assembled sample by sample.
+        """
+        if self._parname in trace.keys():  # Nothing to do
+            return trace[self._parname]
+        else:
+            choice = self._choice.evaluate_batch(trace, N, profiler, seeder)
+            if isinstance(choice, torch.Tensor):
+                choice = choice.cpu().numpy()
+            choice = np.asarray(choice).astype(int).reshape(N)
+            t0 = time.perf_counter()
+            options = {
+                c: self._options[c].evaluate_batch(trace, N, profiler, seeder)
+                for c in set(choice)
+            }
+            result = _collate([options[c][i] for i, c in enumerate(choice)])
             trace[self._parname] = result
+            if profiler is not None:
+                profiler.record(self._parname, time.perf_counter() - t0, result)
             return result
 
 
+class ExecutionPlan:
+    """Compiled evaluation order of a graph, for fixed targets and conditioned variables.
+
+    The plan is a topologically sorted, flat list of steps `(fn, input slots,
+    output slots)`, which operate on a list of slots that holds conditions,
+    constant function arguments and node outputs.  Nodes that are not required
+    for the targets are not part of the plan.
+
+    Plans with asynchronous nodes (`async def` functions) can be evaluated with
+    `arun`, which awaits independent nodes concurrently.  The blocking `run`
+    and `run_batch` methods run them in a new event loop.
+    """
+
+    def __init__(self, graph, targets, condition_keys, profiler=None, seeder=None):
+        """Compiles execution plan.
+
+        Args:
+            graph: Graph instance.
+            targets: List of target sample variables.
+            condition_keys: Names of conditioned sample variables.
+            profiler: Optional `SimulatorProfiler`, which records all function evaluations.
+            seeder: Optional `CounterSeeder`, which seeds random number generators before all function evaluations.
+
+        Raises:
+            TypeError: If the targets depend on `Switch` nodes, which require lazy evaluation.
+        """
+        condition_keys = set(condition_keys)
+        self._seeder = seeder
+        self._template = []  # Initial slot values
+        self._condition_slots = []  # (parname, slot)
+        self._outputs = []  # (parname, slot)
+        self._steps = []  # (fn, input slots, output slot or slots)
+        self._batch_info = []  # (vectorized, sliced inputs, asynchronous, node)
+        self._deps = []  # Indices of steps that produce the inputs
+        producers = {}  # slot -> step index
+        slots = {}
+
+        def new_slot(value=None):
+            self._template.append(value)
+            return len(self._template) - 1
+
+        def visit(node):
+            parname = node._parname
+            if parname in slots:
+                return slots[parname]
+            if parname in condition_keys:
+                slots[parname] = new_slot()
+                self._condition_slots.append((parname, slots[parname]))
+                return slots[parname]
+            if not isinstance(node, Node):
+                raise TypeError("Execution plans do not support %s" % type(node))
+            sliced = tuple(isinstance(arg, (Node, Switch)) for arg in node._inputs)
+            inputs = tuple(
+                visit(arg) if s else new_slot(arg)
+                for arg, s in zip(node._inputs, sliced)
+            )
+            if node._mult_parnames is None:
+                outputs = slots[parname] = new_slot()
+                self._outputs.append((parname, outputs))
+            else:
+                for name in node._mult_parnames:
+                    if name not in slots:
+                        slots[name] = new_slot()
+                    self._outputs.append((name, slots[name]))
+                outputs = tuple(slots[name] for name in node._mult_parnames)
+            self._deps.append(
+                tuple(sorted({producers[i] for i in inputs if i in producers}))
+            )
+            for i in (outputs,) if isinstance(outputs, int) else outputs:
+                producers[i] = len(self._steps)
+            self._steps.append((node._get_fn(profiler, seeder=seeder), inputs, outputs))
+            self._batch_info.append((node._vectorized, sliced, node._is_async, node))
+            return slots[parname]
+
+        for target in targets:
+            visit(graph[target])
+        self.is_async = any(info[2] for info in self._batch_info)
+
+    def _init_slots(self, conditions):
+        slots = self._template.copy()
+        for parname, i in self._condition_slots:
+            slots[i] = conditions[parname]
+        return slots
+
+    def _get_trace(self, slots, conditions):
+        trace = dict(conditions)
+        for parname, i in self._outputs:
+            trace[parname] = slots[i]
+        return trace
+
+    def run(self, conditions):
+        """Evaluates plan for a single sample.
+
+        Args:
+            conditions: Dict with conditioned sample variables.
+
+        Returns:
+            Dict with conditions and all evaluated sample variables.
+        """
+        if self.is_async:
+            return _run_coroutine(self.arun(conditions))
+        slots = self._init_slots(conditions)
+        for fn, inputs, outputs in self._steps:
+            result = fn(*[slots[i] for i in inputs])
+            if isinstance(outputs, int):
+                slots[outputs] = result
+            else:
+                for i, value in zip(outputs, result):
+                    slots[i] = value
+        return self._get_trace(slots, conditions)
+
+    async def arun(self, conditions):
+        """Evaluates plan for a single sample, awaiting independent nodes concurrently.
+
+        Args:
+            conditions: Dict with conditioned sample variables.
+
+        Returns:
+            Dict with conditions and all evaluated sample variables.
+        """
+        slots = self._init_slots(conditions)
+        tasks = []
+
+        async def run_step(k):
+            fn, inputs, outputs = self._steps[k]
+            if self._deps[k]:
+                await asyncio.gather(*(tasks[j] for j in self._deps[k]))
+            result = fn(*[slots[i] for i in inputs])
+            if self._batch_info[k][2]:
+                result = await result
+            if isinstance(outputs, int):
+                slots[outputs] = result
+            else:
+                for i, value in zip(outputs, result):
+                    slots[i] = value
+
+        for k in range(len(self._steps)):
+            tasks.append(asyncio.ensure_future(run_step(k)))
+        await asyncio.gather(*tasks)
+        return self._get_trace(slots, conditions)
+
+    def run_batch(self, conditions, N):
+        """Evaluates plan for a batch of `N` samples (see `Node.evaluate_batch`).
+
+        Args:
+            conditions: Dict with batched conditioned sample variables.
+            N: Number of samples.
+
+        Returns:
+            Dict with batched conditions and evaluated sample variables.
+        """
+        slots = self._init_slots(conditions)
+        for (fn, inputs, outputs), (vectorized, sliced, is_async, node) in zip(
+            self._steps, self._batch_info
+        ):
+            args = [slots[i] for i in inputs]
+            multiple_outputs = not isinstance(outputs, int)
+            seeder = self._seeder
+            if vectorized:
+                result = _call_vectorized(fn, args, N, node._pass_batch_size, seeder)
+                if is_async:
+                    result = _run_coroutine(result)
+                _check_batch(result, N, node._name, multiple_outputs)
+            elif is_async:
+                result = _run_coroutine(
+                    _acall_per_sample(fn, args, sliced, N, multiple_outputs, seeder)
+                )
+            else:
+                result = _call_per_sample(fn, args, sliced, N, multiple_outputs, seeder)
+            if multiple_outputs:
+                for i, value in zip(outputs, result):
+                    slots[i] = value
+            else:
+                slots[outputs] = result
+        return self._get_trace(slots, conditions)
+
+
 class Graph:
     """Defines the computational graph (DAG) and keeps track of simulation results."""
 
     def __init__(self):
         self.nodes = {}
         self._prefix = ""
+        self._plans = {}
 
     def __repr__(self):
         return "Graph(" + self.nodes.__repr__() + ")"
@@ -169,6 +561,7 @@ class Graph:
     def __setitem__(self, key, value):
         if key not in self.nodes.keys():
             self.nodes.__setitem__(key, value)
+            self._plans.clear()
 
     def keys(self):
         return self.nodes.keys()
@@ -176,35 +569,135 @@ class Graph:
     def __getitem__(self, key):
         return self.nodes[key]
 
-    def node(self, parnames, fn, *args):
+    def node(
+        self,
+        parnames,
+        fn,
+        *args,
+        vectorized=False,
+        cache=False,
+        rng=False,
+        seed_torch=False,
+        pass_batch_size=False,
+    ):
         """Register sampling function.
 
         Args:
             parnames: Name or list of names of sampling variables.
-            fn: Callable that returns the (list of) sampling variable(s).
+            fn: Callable that returns the (list of) sampling variable(s).  Can be an `async def` function (see `Simulator.asample`).
             *args: Arguments and keywords arguments that are passed to `fn` upon evaluation.  LazyValues will be automatically evaluated if necessary.
+            vectorized: If True, `fn` is assumed to receive and return arrays/tensors with a leading batch dimension when sampling in vectorized mode (see `Simulator.sample`).  Otherwise, `fn` is called separately for each sample.
+            cache: If True, outputs of `fn` are memoized in a `MemoryCache`,
+                keyed on a hash of the input values.  Alternatively, a cache
+                instance can be provided (e.g. a `DiskCache` for persistent
+                caching).  Only use for deterministic functions.
+            rng: If True, `fn` is called with an additional keyword argument
+                `rng`, a `numpy.random.Generator`.  When sampling with a seed,
+                the generator is derived from the seed, the sample index and
+                the node name (see `Simulator.sample`).
+            seed_torch: If True, the global torch random state is seeded as
+                well when sampling with a seed.  Only needed for nodes that
+                draw random numbers with torch, since seeding torch is slow.
+            pass_batch_size: If True, `fn` receives the batch size as keyword
+                argument `batch_size` in vectorized mode (e.g. for vectorized
+                nodes without inputs).  `batch_size` is not passed when
+                sampling separately, so give it a default.
 
         Returns:
             Node or tuple of nodes.
         """
         assert callable(fn), "Second argument must be a function."
+        assert not (cache and rng), "Cached nodes must be deterministic."
+        if cache is True:
+            cache = MemoryCache()
+        if cache is not False and cache is not None:
+            name = (
+                self._prefix + parnames
+                if isinstance(parnames, str)
+                else ",".join(self._prefix + n for n in parnames)
+            )
+            if _is_async(fn):
+                fn = AsyncCachedFunction(fn, cache, name=name)
+            else:
+                fn = CachedFunction(fn, cache, name=name)
         if isinstance(parnames, str):
             parnames = self._prefix + parnames
-            node = Node(parnames, None, fn, *args)
+            node = Node(
+                parnames,
+                None,
+                fn,
+                *args,
+                vectorized=vectorized,
+                rng=rng,
+                seed_torch=seed_torch,
+                pass_batch_size=pass_batch_size,
+            )
             self.nodes[parnames] = node
+            self._plans.clear()
             return node
         else:
             parnames = [self._prefix + n for n in parnames]
-            nodes = tuple(Node(parname, parnames, fn, *args) for parname in parnames)
+            nodes = tuple(
+                Node(
+                    parname,
+                    parnames,
+                    fn,
+                    *args,
+                    vectorized=vectorized,
+                    rng=rng,
+                    seed_torch=seed_torch,
+                    pass_batch_size=pass_batch_size,
+                )
+                for parname in parnames
+            )
             for i, parname in enumerate(parnames):
                 self.nodes[parname] = nodes[i]
+            self._plans.clear()
             return nodes
 
     def switch(self, parname, options, choice):
         switch = Switch(parname, options, choice)
         self.nodes[parname] = switch
+        self._plans.clear()
         return switch
 
+    def cache_stats(self):
+        """Returns hit/miss counters and cache sizes of all cached nodes.
+
+        Returns:
+            Dict: Cache statistics, keyed by node name.
+        """
+        stats = {}
+        for parname, node in self.nodes.items():
+            if isinstance(node, Node) and isinstance(
+                node._fn, (CachedFunction, AsyncCachedFunction)
+            ):
+                stats[parname] = node._fn.cache.stats()
+        return stats
+
+    def get_plan(self, targets, condition_keys, profiler=None, seeder=None):
+        """Returns cached execution plan for given targets and conditioned variables.
+
+        Args:
+            targets: List of target sample variables.
+            condition_keys: Names of conditioned sample variables.
+            profiler: Optional `SimulatorProfiler`.
+            seeder: Optional `CounterSeeder`.
+
+        Returns:
+            ExecutionPlan, or None if the graph has to be evaluated lazily.
+        """
+        signature = (tuple(targets), frozenset(condition_keys), profiler, seeder)
+        try:
+            return self._plans[signature]
+        except KeyError:
+            try:
+                plan = ExecutionPlan(self, targets, condition_keys, profiler, seeder)
+            except TypeError:
+                plan = None
+            self._plans[signature] = plan
+            return plan
+
     def prefix(self, prefix):
         return GraphPrefixContextManager(self, prefix)
 
@@ -251,9 +744,18 @@ class Simulator:
 
     def __init__(self):
         self.graph = None
+        self.profiler = None
+        self._seeder = CounterSeeder()
 
     #        self.build_graph(self.graph)
 
+    def __getstate__(self):
+        # Graph nodes typically point to lambdas, which cannot be pickled. The
+        # graph is rebuilt with `build` after unpickling (e.g. in worker processes).
+        state = self.__dict__.copy()
+        state["graph"] = None
+        return state
+
     def transform_conditions(self, conditions):
         return conditions
 
@@ -287,17 +789,75 @@ class Simulator:
         """
         return sample
 
-    def _run(self, targets=None, conditions={}):
+    def _build_graph(self):
         if self.graph is None:
             self.graph = Graph()
             self.build(self.graph)
+
+    def _get_seeder(self, seed, indices):
+        if seed is None:
+            return None
+        self._seeder.seed = seed
+        self._seeder.indices = indices
+        self._seeder.index = int(indices[0]) if len(indices) > 0 else 0
+        return self._seeder
+
+    def _get_conditions(self, conditions, seeder=None):
+        if callable(conditions):
+            if seeder is not None:
+                seeder.seed_globals(_CONDITIONS_KEY)
+            conditions = conditions()
+        return self.transform_conditions(conditions)
+
+    def _run(self, targets=None, conditions={}, seeder=None):
+        self._build_graph()
+        conditions = self._get_conditions(conditions, seeder)
+        if targets is None:
+            targets = self.graph.keys()
+        plan = self.graph.get_plan(targets, conditions.keys(), self.profiler, seeder)
+        if plan is not None:
+            trace = plan.run(conditions)
+        else:
+            trace = dict(conditions)
+            for target in targets:
+                self.graph[target].evaluate(trace, self.profiler, seeder)
+        result = self.transform_samples(trace)
+        return result
+
+    def _run_batch(self, N, targets=None, conditions={}, seeder=None):
+        self._build_graph()
+        out = []
+        for i in range(N):
+            if seeder is not None:
+                seeder.index = int(seeder.indices[i])
+            out.append(self._get_conditions(conditions, seeder))
+        conditions = collate_output(out)
+        return self._run_batch_conditioned(N, targets, conditions, seeder)
+
+    def _run_batch_conditioned(self, N, targets, conditions, seeder=None):
+        self._build_graph()
+        if targets is None:
+            targets = self.graph.keys()
+        plan = self.graph.get_plan(targets, conditions.keys(), self.profiler, seeder)
+        if plan is not None:
+            trace = plan.run_batch(conditions, N)
+        else:
+            trace = dict(conditions)
+            for target in targets:
+                self.graph[target].evaluate_batch(trace, N, self.profiler, seeder)
+        result = self.transform_samples(trace)
+        return result
+
+    async def _arun(self, targets=None, conditions={}):
+        self._build_graph()
         conditions = conditions() if callable(conditions) else conditions
         conditions = self.transform_conditions(conditions)
-        trace = dict(conditions)
         if targets is None:
             targets = self.graph.keys()
-        for target in targets:
-            self.graph[target].evaluate(trace)
+        plan = self.graph.get_plan(targets, conditions.keys(), self.profiler)
+        if plan is None:
+            raise TypeError("Asynchronous sampling does not support Switch nodes.")
+        trace = await plan.arun(conditions)
         result = self.transform_samples(trace)
         return result
 
@@ -312,9 +872,7 @@ class Simulator:
             (Dict, Dict): Dictionary of shapes and dictionary of dtypes
         """
         sample = self.sample(targets=targets)
-        shapes = {k: tuple(v.shape) for k, v in sample.items()}
-        dtypes = {k: v.dtype for k, v in sample.items()}
-        return shapes, dtypes
+        return _get_shapes_and_dtypes(sample)
 
     def sample(
         self,
@@ -322,6 +880,11 @@ class Simulator:
         targets: Optional[Sequence[str]] = None,
         conditions: Union[Dict, Callable] = {},
         exclude: Optional[Sequence[str]] = [],
+        vectorized: bool = False,
+        num_workers: int = 0,
+        seed: Optional[int] = None,
+        indices: Optional[Union[int, Sequence[int]]] = None,
+        executor: Optional[ProcessPoolExecutor] = None,
     ):
         """Sample from the simulator.
 
@@ -333,29 +896,359 @@ class Simulator:
                 a dictionary with conditions.
             exclude: Optional list of parameters that are excluded from the
                 returned samples.  Can be used to reduce memory consumption.
+            vectorized: If True, all `N` samples are passed through the
+                computational graph in one go.  Nodes registered with
+                `vectorized=True` are called once with batched inputs, all
+                other nodes are called once per sample.  Note that in this mode
+                `transform_samples` is applied to the batched samples.
+            num_workers: If larger than zero, samples are generated in chunks
+                by a pool of `num_workers` processes.  Each worker rebuilds the
+                graph with `build`, and its random number generators are
+                seeded independently.  The simulator and `conditions` must be
+                picklable.
+            seed: If not None, random numbers are drawn from counter-based
+                streams.  Before each node evaluation, the global numpy random
+                state is seeded from `(seed, sample index, node name)`, and
+                nodes registered with `rng=True` receive a Philox generator
+                derived from the same triple.  The global torch random state is
+                only seeded for nodes registered with `seed_torch=True`, and
+                for callable `conditions`.  Global random states are restored
+                after sampling.  Each sample can hence
+                be regenerated independently, and results of per-sample nodes
+                do not depend on `num_workers` or chunking.  Vectorized nodes
+                are seeded once per batch, using the index of its first
+                sample, such that their outputs do depend on how samples are
+                split into batches (e.g. `chunk` in `sample_iter`).
+            indices: Sample indices used for seeding, defaults to `range(N)`
+                (or 0 for a single sample).
+            executor: Optional worker pool of `num_workers` processes from
+                `get_executor`, which is used instead of starting a new pool.
         """
+        with _restore_global_rng(seed is not None):
+            return self._sample_seeded(
+                N,
+                targets,
+                conditions,
+                exclude,
+                vectorized,
+                num_workers,
+                seed,
+                indices,
+                executor,
+            )
+
+    def _sample_seeded(
+        self,
+        N,
+        targets,
+        conditions,
+        exclude,
+        vectorized,
+        num_workers,
+        seed,
+        indices,
+        executor,
+    ):
+        if executor is not None and num_workers < 1:
+            raise ValueError("num_workers is required if an executor is provided.")
         if N is None:
-            return Sample(self._run(targets, conditions))
+            indices = [0 if indices is None else indices]
+            seeder = self._get_seeder(seed, indices)
+            return Sample(self._run(targets, conditions, seeder))
+
+        if num_workers > 0:
+            return self._sample_parallel(
+                N,
+                targets,
+                conditions,
+                exclude,
+                vectorized,
+                num_workers,
+                seed,
+                indices,
+                executor,
+            )
 
-        out = []
-        for _ in tqdm(range(N)):
-            result = self._run(targets, conditions)
+        return self._sample(
+            N, targets, conditions, exclude, vectorized, seed=seed, indices=indices
+        )
+
+    def _sample(
+        self,
+        N,
+        targets,
+        conditions,
+        exclude,
+        vectorized=False,
+        progress_bar=True,
+        seed=None,
+        indices=None,
+    ):
+        indices = np.arange(N) if indices is None else np.asarray(indices)
+        seeder = self._get_seeder(seed, indices)
+        if vectorized:
+            out = self._run_batch(N, targets, conditions, seeder)
+            for key in exclude:
+                out.pop(key, None)
+            return Samples(out)
+
+        out = None
+        for i in tqdm(range(N), disable=not progress_bar):
+            if seeder is not None:
+                seeder.index = int(indices[i])
+            result = self._run(targets, conditions, seeder)
             for key in exclude:
                 result.pop(key, None)
-            out.append(result)
-        out = collate_output(out)
+            if out is None:
+                out = _allocate_output(result, N)
+            _write_output(out, i, result)
         out = Samples(out)
         return out
 
-    def get_resampler(self, targets):
+    async def asample(
+        self,
+        N: Optional[int] = None,
+        targets: Optional[Sequence[str]] = None,
+        conditions: Union[Dict, Callable] = {},
+        exclude: Optional[Sequence[str]] = [],
+        concurrency: int = 16,
+    ):
+        """Sample from the simulator asynchronously.
+
+        Intended for simulators with I/O-bound nodes that are defined as
+        `async def` functions (e.g. running external programs via
+        `asyncio.create_subprocess_exec`).  Up to `concurrency` samples are
+        in flight at the same time on the running event loop, and independent
+        nodes of each sample are awaited concurrently.  Regular nodes are
+        executed directly in the event loop.
+
+        Example usage:
+
+        .. code-block:: python
+
+           samples = asyncio.run(simulator.asample(100, concurrency=32))
+
+        Args:
+            N: Number of samples to generate.  If None, a single sample without sample dimension is returned.
+            targets, conditions, exclude: See `sample`.
+            concurrency: Maximum number of samples that are generated concurrently.
+        """
+        if N is None:
+            return Sample(await self._arun(targets, conditions))
+
+        semaphore = asyncio.Semaphore(concurrency)
+        out = None
+        progress_bar = tqdm(total=N)
+
+        async def run(i):
+            nonlocal out
+            async with semaphore:
+                result = await self._arun(targets, conditions)
+            for key in exclude:
+                result.pop(key, None)
+            if out is None:
+                out = _allocate_output(result, N)
+            _write_output(out, i, result)
+            progress_bar.update(1)
+
+        try:
+            await asyncio.gather(*(run(i) for i in range(N)))
+        finally:
+            progress_bar.close()
+        return Samples(out)
+
+    def _sample_parallel(
+        self,
+        N,
+        targets,
+        conditions,
+        exclude,
+        vectorized,
+        num_workers,
+        seed,
+        indices,
+        executor=None,
+    ):
+        chunk = int(math.ceil(N / (4 * num_workers)))
+        out = None
+        i = 0
+        for samples in self.sample_iter(
+            N,
+            chunk,
+            targets,
+            conditions,
+            exclude,
+            vectorized,
+            num_workers,
+            seed,
+            indices,
+            executor,
+        ):
+            if out is None:
+                out = _allocate_output({k: v[0] for k, v in samples.items()}, N)
+            n = len(samples)
+            _write_output(out, slice(i, i + n), samples)
+            i += n
+        return Samples(out)
+
+    def sample_iter(
+        self,
+        N: int,
+        chunk: int,
+        targets: Optional[Sequence[str]] = None,
+        conditions: Union[Dict, Callable] = {},
+        exclude: Optional[Sequence[str]] = [],
+        vectorized: bool = False,
+        num_workers: int = 0,
+        seed: Optional[int] = None,
+        indices: Optional[Sequence[int]] = None,
+        executor: Optional[ProcessPoolExecutor] = None,
+    ):
+        """Generator that samples from the simulator in chunks.
+
+        Only one chunk is held in memory at a time (or up to `2 * num_workers`
+        chunks, when sampling in parallel), independent of `N`.
+
+        Args:
+            N: Total number of samples to generate.
+            chunk: Number of samples per chunk.
+            targets, conditions, exclude, vectorized, num_workers, seed, indices: See `sample`.
+            executor: Optional worker pool of `num_workers` processes from
+                `get_executor`, which is used instead of starting a new pool.
+                Reuse it to avoid repeated pool startup across calls.
+
+        Yields:
+            Samples: Chunks of samples, in order, with `chunk` samples each (the last one may be shorter).
+        """
+        if executor is not None and num_workers < 1:
+            raise ValueError("num_workers is required if an executor is provided.")
+        indices = np.arange(N) if indices is None else np.asarray(indices)
+        chunks = [indices[i : i + chunk] for i in range(0, N, chunk)]
+        args = (targets, conditions, exclude, vectorized)
+        with tqdm(total=N) as progress_bar:
+            if executor is None and num_workers > 0:
+                with self.get_executor(num_workers) as executor:
+                    yield from self._iter_parallel(
+                        executor, num_workers, chunks, args, seed, progress_bar
+                    )
+            elif executor is not None:
+                yield from self._iter_parallel(
+                    executor, num_workers, chunks, args, seed, progress_bar
+                )
+            else:
+                for idx in chunks:
+                    samples = self._sample(len(idx), *args, False, seed, idx)
+                    progress_bar.update(len(idx))
+                    yield samples
+
+    def _iter_parallel(self, executor, num_workers, chunks, args, seed, progress_bar):
+        jobs = chunks[::-1]
+        futures = deque()
+        while jobs or futures:
+            # Limit number of pending chunks to bound memory usage
+            while jobs and len(futures) < 2 * num_workers:
+                idx = jobs.pop()
+                futures.append(self.submit(executor, len(idx), *args, seed, idx))
+            samples = futures.popleft().result()
+            progress_bar.update(len(samples))
+            yield samples
+
+    def get_executor(self, num_workers: int):
+        """Returns pool of `num_workers` processes for `submit` and `sample_iter`.
+
+        The simulator is sent to each worker once, which builds the graph
+        once, such that the pool can be reused for many chunks of samples.
+        Changes to the simulator after creating the pool are not seen by
+        the workers.
+        """
+        return ProcessPoolExecutor(
+            max_workers=num_workers, initializer=_init_worker, initargs=(self,)
+        )
+
+    def submit(
+        self,
+        executor: ProcessPoolExecutor,
+        N: int,
+        targets: Optional[Sequence[str]] = None,
+        conditions: Union[Dict, Callable] = {},
+        exclude: Optional[Sequence[str]] = [],
+        vectorized: bool = False,
+        seed: Optional[int] = None,
+        indices: Optional[Sequence[int]] = None,
+    ):
+        """Sample in a worker process of a pool from `get_executor`.
+
+        Args:
+            executor: Worker pool from `get_executor`.
+            N, targets, conditions, exclude, vectorized, seed, indices: See `sample`.
+
+        Returns:
+            Future of `Samples`.
+        """
+        (worker_seed,) = _spawn_seeds(1)
+        args = (targets, conditions, exclude, vectorized, False, seed, indices)
+        future = executor.submit(_sample_in_worker, worker_seed, N, *args)
+        out = Future()
+
+        def done(future):
+            try:
+                samples, stats = future.result()
+            except BaseException as e:
+                out.set_exception(e)
+                return
+            if stats is not None and self.profiler is not None:
+                self.profiler.merge(stats)
+            out.set_result(samples)
+
+        future.add_done_callback(done)
+        return out
+
+    def enable_profiling(self, enabled: bool = True):
+        """Enable or disable profiling of node evaluations.
+
+        When enabled, wall time, number of calls and output size are recorded
+        for every node evaluation, aggregated over all subsequent runs.
+        Statistics of worker processes (`num_workers > 0`) are sent back with
+        each chunk of samples and merged.  Switch times include the
+        evaluation of the selected options.  Enabling profiling resets
+        previous statistics.
+
+        Args:
+            enabled: Enable or disable profiling.
+        """
+        self.profiler = SimulatorProfiler() if enabled else None
+
+    def profile_report(self):
+        """Returns table with profiling statistics (see `enable_profiling`)."""
+        if self.profiler is None:
+            raise RuntimeError("Profiling not enabled.")
+        return self.profiler.report()
+
+    def export_profile(self, path: Optional[str] = None):
+        """Export profiling statistics as JSON.
+
+        Args:
+            path: Optional output file.
+
+        Returns:
+            str: JSON string.
+        """
+        if self.profiler is None:
+            raise RuntimeError("Profiling not enabled.")
+        return self.profiler.to_json(path)
+
+    def get_resampler(self, targets, batched=False):
         """Generates a resampler. Useful for noise hooks etc.
 
         Args:
             targets: List of target variables to simulate
+            batched: If True, return a resampler that operates on collated minibatches.
 
         Returns:
-            SimulatorResampler instance.
+            SimulatorResampler or BatchedSimulatorResampler instance.
         """
+        if batched:
+            return BatchedSimulatorResampler(self, targets)
         return SimulatorResampler(self, targets)
 
     def get_iterator(self, targets=None, conditions={}):
@@ -373,6 +1266,251 @@ class Simulator:
         return iterator
 
 
+class SimulatorProfiler:
+    """Collects wall time, number of calls and output byte size per node."""
+
+    def __init__(self):
+        self.stats = {}
+
+    def record(self, name, dt, value):
+        try:
+            stats = self.stats[name]
+        except KeyError:
+            stats = self.stats[name] = dict(calls=0, time=0.0, nbytes=0)
+        stats["calls"] += 1
+        stats["time"] += dt
+        stats["nbytes"] += _nbytes(value)
+
+    def reset(self):
+        self.stats.clear()
+
+    def merge(self, stats):
+        """Adds statistics recorded by another profiler (e.g. in a worker process)."""
+        for name, other in stats.items():
+            own = self.stats.setdefault(name, dict(calls=0, time=0.0, nbytes=0))
+            for k in own:
+                own[k] += other[k]
+
+    def report(self):
+        """Returns table with profiling statistics, sorted by total time."""
+        rows = sorted(self.stats.items(), key=lambda x: -x[1]["time"])
+        width = max([4] + [len(name) for name, _ in rows])
+        lines = [
+            "%-*s %10s %12s %12s %14s"
+            % (width, "node", "calls", "total [s]", "mean [ms]", "output [MB]")
+        ]
+        for name, stats in rows:
+            lines.append(
+                "%-*s %10i %12.4f %12.4f %14.3f"
+                % (
+                    width,
+                    name,
+                    stats["calls"],
+                    stats["time"],
+                    stats["time"] / stats["calls"] * 1e3,
+                    stats["nbytes"] / 2**20,
+                )
+            )
+        return "\n".join(lines)
+
+    def to_json(self, path=None):
+        """Returns statistics as JSON string, and optionally writes it to `path`."""
+        out = json.dumps(self.stats, indent=2)
+        if path is not None:
+            with open(path, "w") as f:
+                f.write(out)
+        return out
+
+
+class ProfiledFunction:
+    """Wraps function, and records its evaluations in a `SimulatorProfiler`."""
+
+    def __init__(self, fn, name, profiler):
+        self.fn = fn
+        self.name = name
+        self.profiler = profiler
+
+    def __call__(self, *args, **kwargs):
+        t0 = time.perf_counter()
+        result = self.fn(*args, **kwargs)
+        self.profiler.record(self.name, time.perf_counter() - t0, result)
+        return result
+
+
+class AsyncProfiledFunction(ProfiledFunction):
+    """Wraps coroutine function, and records its evaluations (including waiting time)."""
+
+    async def __call__(self, *args, **kwargs):
+        t0 = time.perf_counter()
+        result = await self.fn(*args, **kwargs)
+        self.profiler.record(self.name, time.perf_counter() - t0, result)
+        return result
+
+
+def _node_key(name):
+    """Stable 32-bit integer key for node names."""
+    return int.from_bytes(hashlib.sha1(name.encode()).digest()[:4], "little")
+
+
+_CONDITIONS_KEY = _node_key("__conditions__")
+
+
+class CounterSeeder:
+    """Derives random number streams from `(seed, sample index, node name)`.
+
+    All streams are obtained via `numpy.random.SeedSequence(seed,
+    spawn_key=(index, node key, ...))`, such that random numbers drawn for one
+    node and sample do not depend on any other node or sample.
+    """
+
+    def __init__(self):
+        self.seed = 0
+        self.index = 0
+        self.indices = [0]
+
+    def seed_sequence(self, key, stream=0):
+        return np.random.SeedSequence(self.seed, spawn_key=(self.index, key, stream))
+
+    def seed_globals(self, key, seed_torch=True):
+        """Seed global numpy and (optionally) torch random states."""
+        seed_sequence = self.seed_sequence(key)
+        np.random.seed(seed_sequence.generate_state(4))
+        if seed_torch:
+            torch.manual_seed(int(seed_sequence.generate_state(1, np.uint64)[0]))
+
+    def get_rng(self, key):
+        """Returns independent Philox-based numpy random number generator."""
+        return np.random.Generator(np.random.Philox(self.seed_sequence(key, 1)))
+
+
+class SeededFunction:
+    """Wraps function, and seeds random number generators before each call.
+
+    Args:
+        fn: Node function.
+        name: Node name.
+        seeder: `CounterSeeder` instance, or None.  If None, the `rng` argument
+            is derived from the global numpy random state.
+        pass_rng: If True, pass generator to `fn` as keyword argument `rng`.
+        seed_torch: If True, seed the global torch random state as well.
+    """
+
+    def __init__(self, fn, name, seeder, pass_rng, seed_torch=False):
+        self.fn = fn
+        self.key = _node_key(name)
+        self.seeder = seeder
+        self.pass_rng = pass_rng
+        self.seed_torch = seed_torch
+
+    def __call__(self, *args, **kwargs):
+        if self.seeder is None:
+            rng = np.random.default_rng(np.random.randint(0, 2**31, size=4))
+            return self.fn(*args, rng=rng, **kwargs)
+        self.seeder.seed_globals(self.key, self.seed_torch)
+        if self.pass_rng:
+            return self.fn(*args, rng=self.seeder.get_rng(self.key), **kwargs)
+        return self.fn(*args, **kwargs)
+
+
+def _get_shapes_and_dtypes(sample):
+    shapes = {k: tuple(v.shape) for k, v in sample.items()}
+    dtypes = {k: v.dtype for k, v in sample.items()}
+    return shapes, dtypes
+
+
+def _allocate_output(sample, N):
+    """Allocate arrays/tensors for `N` samples with the shapes and dtypes of `sample`."""
+    sample = {
+        k: v if isinstance(v, torch.Tensor) else np.asarray(v)
+        for k, v in sample.items()
+    }
+    shapes, dtypes = _get_shapes_and_dtypes(sample)
+    out = {}
+    for k, v in sample.items():
+        if isinstance(v, torch.Tensor):
+            out[k] = torch.empty((N, *shapes[k]), dtype=dtypes[k], device=v.device)
+        else:
+            out[k] = np.empty((N, *shapes[k]), dtype=dtypes[k])
+    return out
+
+
+def _write_output(out, i, sample):
+    """Write `sample` to position `i` (index or slice) of arrays allocated by `_allocate_output`.
+
+    Raises ValueError if values do not match the shapes of the arrays, or
+    cannot be cast to their dtypes without loss.
+    """
+    label = i if isinstance(i, int) else "%i:%i" % (i.start, i.stop)
+    for k, buffer in out.items():
+        if isinstance(buffer, torch.Tensor):
+            value = torch.as_tensor(sample[k])
+            castable = torch.can_cast(value.dtype, buffer.dtype)
+        else:
+            value = np.asarray(sample[k])
+            castable = np.can_cast(value.dtype, buffer.dtype, "same_kind")
+        shape = tuple(buffer[i].shape)
+        if tuple(value.shape) != shape:
+            raise ValueError(
+                "Output '%s' at sample %s has shape %s, expected %s."
+                % (k, label, tuple(value.shape), shape)
+            )
+        if not castable:
+            raise ValueError(
+                "Output '%s' at sample %s has dtype %s, which cannot be stored as %s."
+                % (k, label, value.dtype, buffer.dtype)
+            )
+        buffer[i] = value
+
+
+def _spawn_seeds(n):
+    """Spawn `n` independent seed sequences.
+
+    The root entropy is drawn from the global numpy random state, such that
+    seeding numpy in the main process makes parallel sampling reproducible.
+    """
+    root = np.random.SeedSequence(np.random.randint(0, 2**31, size=4))
+    return root.spawn(n)
+
+
+_WORKER_SIMULATOR = None
+
+
+def _init_worker(simulator):
+    """Keep simulator in worker processes of `Simulator.get_executor` pools."""
+    global _WORKER_SIMULATOR
+    _WORKER_SIMULATOR = simulator
+
+
+def _sample_in_worker(seed, *args):
+    """Returns samples, and profiling statistics of this call (or None)."""
+    profiler = _WORKER_SIMULATOR.profiler
+    if profiler is not None:
+        profiler.reset()
+    samples = _call_seeded(seed, _WORKER_SIMULATOR._sample, *args)
+    return samples, None if profiler is None else dict(profiler.stats)
+
+
+@contextlib.contextmanager
+def _restore_global_rng(enabled=True):
+    """Restores the global numpy and torch random states on exit."""
+    if not enabled:
+        yield
+        return
+    np_state, torch_state = np.random.get_state(), torch.get_rng_state()
+    try:
+        yield
+    finally:
+        np.random.set_state(np_state)
+        torch.set_rng_state(torch_state)
+
+
+def _call_seeded(seed, fn, *args, **kwargs):
+    """Seed the global numpy and torch random states, and call `fn`."""
+    np.random.seed(seed.generate_state(4))
+    torch.manual_seed(int(seed.generate_state(1, np.uint64)[0]))
+    return fn(*args, **kwargs)
+
+
 class SimulatorResampler:
     """Handles rerunning part of the simulator. Typically used for on-the-fly calculations during training."""
 
@@ -402,6 +1540,41 @@ class SimulatorResampler:
         return sims
 
 
+class BatchedSimulatorResampler(SimulatorResampler):
+    """Handles rerunning part of the simulator for entire minibatches.
+
+    The targets are regenerated for the whole batch in one pass through the
+    computational graph, as in `Simulator.sample(..., vectorized=True)`, such
+    that nodes registered with `vectorized=True` are called only once per
+    batch.  Note that `transform_conditions` and `transform_samples` are
+    applied to batched samples.
+
+    Example usage:
+
+    .. code-block:: python
+
+       resampler = simulator.get_resampler(targets=["x"], batched=True)
+       dm = swyft.SwyftDataModule(samples, fractions=[0.8, 0.1, 0.1], on_after_load_batch=resampler)
+    """
+
+    def __call__(self, batch):
+        """Resamples.
+
+        Args:
+            batch: Dict with batched sample variables.
+
+        Returns:
+            Samples: batch with resampled sites
+        """
+        N = len(next(iter(batch.values())))
+        conditions = dict(batch)
+        for k in self._targets:
+            conditions.pop(k, None)
+        conditions = self._simulator.transform_conditions(conditions)
+        sims = self._simulator._run_batch_conditioned(N, self._targets, conditions)
+        return Samples(sims)
+
+
 # class Trace(dict):
 #    """Defines the computational graph (DAG) and keeps track of simulation results."""
 #
@@ -0,0 +1,76 @@
+import pickle
+import numpy as np
+import torch
+import swyft
+
+from tests.test_simulator import Simulator
+
+
+def get_store(tmp_path, N=100, chunk_size=16, seed=None):
+    sim = Simulator()
+    shapes, dtypes = sim.get_shapes_and_dtypes()
+    store = swyft.MemmapStore(str(tmp_path / "store"))
+    store.init(N, chunk_size, shapes=shapes, dtypes=dtypes, seed=seed)
+    return sim, store
+
+
+def test_memmapstore_simulate(tmp_path):
+    sim, store = get_store(tmp_path)
+    store.simulate(sim, max_sims=30)
+    assert store.sims_required == 70
+    store.simulate(sim.sample, batch_size=25)
+    assert store.sims_required == 0
+    assert len(np.unique(store["z"][:, 0])) == 100
+    # Reopened store sees the same data
+    store2 = swyft.MemmapStore(str(tmp_path / "store"))
+    assert len(store2) == 100 and np.all(store2["x"] == store["x"])
+
+
+def test_memmapstore_expired_lease(tmp_path):
+    sim, store = get_store(tmp_path, N=10)
+    lease1, idx1 = store._lease_slots(10, timeout=-1.0)  # Expires immediately
+    lease2, idx2 = store._lease_slots(10, timeout=3600.0)
+    assert np.all(idx1 == idx2)
+    samples = sim.sample(10)
+    assert store._store_samples(samples, idx2, lease2) == 10
+    assert store._store_samples(sim.sample(10), idx1, lease1) == 0
+    assert np.all(store["z"] == samples["z"])
+
+
+def test_memmapstore_num_workers(tmp_path, monkeypatch):
+    sim, store = get_store(tmp_path, seed=3)
+    pools = []
+    get_executor = sim.get_executor
+    monkeypatch.setattr(
+        sim, "get_executor", lambda n: pools.append(n) or get_executor(n)
+    )
+    store.simulate(sim, batch_size=25, num_workers=2)
+    assert pools == [2]  # One pool for all batches
+    assert np.all(
+        store["x"][10:15] == sim.sample(5, seed=3, indices=range(10, 15))["x"]
+    )
+
+
+def test_memmapstore_seed(tmp_path):
+    sim, store = get_store(tmp_path, seed=3)
+    store.simulate(sim)
+    samples = sim.sample(5, seed=3, indices=[10, 11, 12, 13, 14])
+    assert np.all(store["x"][10:15] == samples["x"])
+
+
+def test_memmapstore_dataset(tmp_path):
+    sim, store = get_store(tmp_path)
+    store.simulate(sim)
+    dataset = store.get_dataset(idx_range=(10, 20))
+    assert len(dataset) == 10
+    sample = dataset[0]
+    assert isinstance(sample["x"], torch.Tensor)
+    assert np.shares_memory(sample["x"].numpy(), store["x"])
+    dataset = store.get_dataset(indices=[3, 7])
+    assert len(dataset) == 2 and np.all(dataset[1]["x"].numpy() == store["x"][7])
+    store = pickle.loads(pickle.dumps(store))
+    dl = store.get_dataloader(batch_size=8, num_workers=2)
+    assert sum(len(batch["x"]) for batch in dl) == 96
+    dm = swyft.SwyftDataModule(store, lengths=[60, 20, 20], batch_size=8)
+    dm.setup("fit")
+    assert len(dm.dataset_val) == 20
@@ -1,4 +1,9 @@
+import asyncio
+import json
+import os
 import numpy as np
+import pytest
+import torch
 from scipy import stats
 import swyft
 
@@ -18,3 +23,328 @@ class Simulator(swyft.Simulator):
 def test_simulator():
     sim = Simulator()
     samples = sim.sample(N=10)
+
+
+class VectorizedSimulator(swyft.Simulator):
+    def __init__(self):
+        super().__init__()
+        self.transform_samples = swyft.to_numpy32
+        self.x = np.linspace(-1, 1, 10)
+
+    def build(self, graph):
+        z = graph.node("z", lambda: np.random.rand(2) * 2 - 1)
+        f = graph.node("f", lambda z: z[:, :1] + z[:, 1:] * self.x, z, vectorized=True)
+        x = graph.node("x", lambda f: f + np.random.randn(10) * 0.1, f)
+
+
+def test_simulator_vectorized():
+    sim = VectorizedSimulator()
+    samples = sim.sample(N=10, vectorized=True)
+    assert samples["z"].shape == (10, 2)
+    assert samples["x"].shape == (10, 10)
+    assert np.allclose(samples["f"][3], samples["z"][3, 0] + samples["z"][3, 1] * sim.x)
+    samples = sim.sample(
+        N=5, vectorized=True, conditions={"z": np.zeros(2)}, exclude=["f"]
+    )
+    assert "f" not in samples.keys()
+    assert np.all(samples["z"] == 0.0)
+
+
+def test_simulator_vectorized_batch_size():
+    class BatchSimulator(swyft.Simulator):
+        def build(self, graph):
+            z = graph.node(
+                "z",
+                lambda batch_size=1: np.random.rand(batch_size, 2),
+                vectorized=True,
+                pass_batch_size=True,
+            )
+            # Inputs may be called `N`, and cached nodes receive the batch size
+            graph.node(
+                "x",
+                lambda N, batch_size=1: N[:, 0] + np.zeros(batch_size),
+                z,
+                vectorized=True,
+                cache=True,
+                pass_batch_size=True,
+            )
+
+    class BrokenSimulator(swyft.Simulator):
+        def build(self, graph):
+            graph.node("z", lambda: np.random.rand(2), vectorized=True)
+
+    samples = BatchSimulator().sample(5, vectorized=True)
+    assert samples["z"].shape == (5, 2) and samples["x"].shape == (5,)
+    with pytest.raises(ValueError):
+        BrokenSimulator().sample(5, vectorized=True)
+
+
+def test_simulator_inconsistent_outputs():
+    class ShapeSimulator(swyft.Simulator):
+        def build(self, graph):
+            values = iter([np.zeros(3), np.zeros(1)])
+            graph.node("z", lambda: next(values))
+
+    class DtypeSimulator(swyft.Simulator):
+        def build(self, graph):
+            values = iter([1, 2.5])
+            graph.node("z", lambda: next(values))
+
+    with pytest.raises(ValueError, match="'z'.*shape"):
+        ShapeSimulator().sample(2)
+    with pytest.raises(ValueError, match="'z'.*dtype"):
+        DtypeSimulator().sample(2)
+
+
+def test_simulator_num_workers():
+    sim = Simulator()
+    samples = sim.sample(N=20, num_workers=2)
+    assert samples["x"].shape == (20, 10)
+    assert len(np.unique(samples["z"][:, 0])) == 20
+
+
+def test_simulator_execution_plan():
+    sim = Simulator()
+    samples = sim.sample(N=5, targets=["f"])
+    assert set(samples.keys()) == {"z", "f"}
+    sample = sim.sample(conditions={"f": np.zeros(10)}, targets=["x"])
+    assert set(sample.keys()) == {"f", "x"}
+    assert len(sim.graph._plans) == 2
+    plan = sim.graph.get_plan(["x"], ["f"])
+    assert len(plan._steps) == 1
+
+
+class SwitchSimulator(swyft.Simulator):
+    def build(self, graph):
+        c = graph.node("c", lambda: np.random.randint(2))
+        a = graph.node("a", lambda: np.zeros(1))
+        b = graph.node("b", lambda: np.ones(1))
+        graph.switch("s", [a, b], c)
+
+
+def test_simulator_switch():
+    sim = SwitchSimulator()
+    sample = sim.sample(targets=["s"])
+    assert sample["s"][0] == sample["c"]
+    assert sim.graph.get_plan(["s"], []) is None
+    samples = sim.sample(N=10, targets=["s"], vectorized=True)
+    assert np.all(samples["s"][:, 0] == samples["c"])
+
+
+class TorchSimulator(swyft.Simulator):
+    def build(self, graph):
+        z = graph.node("z", lambda: torch.rand(2))
+        x = graph.node("x", lambda z: z * 2.0, z)
+
+
+def test_simulator_preallocated_output():
+    sim = TorchSimulator()
+    samples = sim.sample(N=4, exclude=["z"])
+    assert list(samples.keys()) == ["x"]
+    assert isinstance(samples["x"], torch.Tensor)
+    assert samples["x"].shape == (4, 2)
+    samples = Simulator().sample(N=4)
+    assert samples["x"].dtype == np.float32
+
+
+class CachedSimulator(swyft.Simulator):
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+
+    def model(self, z):
+        self.calls += 1
+        return z * 2.0
+
+    def build(self, graph):
+        z = graph.node("z", lambda: np.random.rand(2))
+        f = graph.node("f", self.model, z, cache=True)
+        x = graph.node("x", lambda f: f + np.random.randn(2), f)
+
+
+def test_simulator_node_cache():
+    sim = CachedSimulator()
+    z = np.array([0.1, 0.2])
+    samples = sim.sample(N=5, conditions={"z": z})
+    assert sim.calls == 1
+    assert sim.graph.cache_stats()["f"]["hits"] == 4
+    samples["f"][0] += 1.0
+    assert np.allclose(sim.sample(conditions={"z": z})["f"], z * 2.0)
+
+
+def test_memory_cache_eviction():
+    cache = swyft.MemoryCache(max_bytes=2 * 80)
+    for i in range(3):
+        cache.put(str(i), np.zeros(10))
+    assert len(cache) == 2 and cache.nbytes == 160
+    assert "0" not in cache
+    cache.get("1")
+    cache.put("3", np.zeros(10))
+    assert "1" in cache and "2" not in cache
+
+
+def test_disk_cache(tmp_path):
+    cache = swyft.DiskCache(str(tmp_path / "cache"), version="v1", max_bytes=200)
+    cache.put("a", (np.ones(10), torch.zeros(3), 1.5))
+    x, y, z = cache.get("a")
+    assert np.all(x == 1.0) and isinstance(y, torch.Tensor) and z == 1.5
+    cache.put("b", np.ones(10))
+    cache.put("c", np.ones(10))
+    assert "a" not in cache and "b" in cache and "c" in cache
+    assert "b" not in swyft.DiskCache(str(tmp_path / "cache"), version="v2")
+    cache.put("c", np.ones(10))  # Overwriting does not count twice
+    assert cache._get_total() == cache.stats()["nbytes"] == 160
+
+
+def test_disk_cache_errors(tmp_path, monkeypatch):
+    path = str(tmp_path / "cache")
+    cache = swyft.DiskCache(path)
+    cache.put("a", np.ones(10))
+
+    def save(filename, *args, **kwargs):
+        open(filename, "w").close()
+        raise OSError(28, "No space left on device")
+
+    monkeypatch.setattr(np, "save", save)
+    cache.put("a", (np.ones(10), np.ones(10)))  # Partial entry is dropped
+    cache.put("b", np.ones(10))
+    assert "a" not in cache and "b" not in cache
+    assert set(os.listdir(path)) == {".stats", ".index", ".lock.file"}
+    assert cache._get_total() == 0
+    # Counters of exited processes are merged
+    with open(os.path.join(path, ".stats", "999999999-0000"), "w") as f:
+        json.dump(dict(hits=3, misses=1), f)
+    cache = swyft.DiskCache(path)
+    cache._count(hits=1)
+    assert len(os.listdir(os.path.join(path, ".stats"))) == 2
+    assert cache.stats()["hits"] == 4 and cache.stats()["misses"] == 1
+
+
+def test_simulator_profiling(tmp_path):
+    sim = Simulator()
+    sim.sample(N=5)
+    sim.enable_profiling()
+    sim.sample(N=5)
+    sim.sample(N=5, vectorized=True)
+    profile = sim.profiler.stats
+    assert profile["x"]["calls"] == 10
+    assert profile["x"]["nbytes"] == 10 * 10 * 8
+    assert "x" in sim.profile_report()
+    sim.export_profile(str(tmp_path / "profile.json"))
+    sim.sample(N=20, num_workers=2)  # Statistics of worker processes
+    assert sim.profiler.stats["x"]["calls"] == 30
+    sim = SwitchSimulator()
+    sim.enable_profiling()
+    sim.sample(N=5, targets=["s"], vectorized=True)
+    assert sim.profiler.stats["s"]["time"] > 0.0
+    sim.enable_profiling(False)
+    sim.sample(N=5)
+    assert sim.profiler is None
+
+
+def test_simulator_sample_iter():
+    sim = Simulator()
+    chunks = list(sim.sample_iter(10, 4, exclude=["f"]))
+    assert [len(c) for c in chunks] == [4, 4, 2]
+    assert "f" not in chunks[0].keys()
+    # Worker pool reused across calls
+    with sim.get_executor(2) as executor:
+        for _ in range(2):
+            chunks = list(
+                sim.sample_iter(10, 4, num_workers=2, seed=1, executor=executor)
+            )
+            assert np.all(
+                np.concatenate([c["x"] for c in chunks]) == sim.sample(10, seed=1)["x"]
+            )
+
+
+class AsyncSimulator(swyft.Simulator):
+    def __init__(self):
+        super().__init__()
+        self.active = 0  # Number of running `slow` calls
+        self.max_active = 0
+
+    def build(self, graph):
+        async def slow(z):
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            await asyncio.sleep(0.01)
+            self.active -= 1
+            return z * 2.0
+
+        z = graph.node("z", lambda: np.random.rand(2))
+        a = graph.node("a", slow, z)
+        b = graph.node("b", slow, z)
+        x = graph.node("x", lambda a, b: a + b, a, b)
+
+
+class RngSimulator(swyft.Simulator):
+    def build(self, graph):
+        z = graph.node("z", lambda rng: rng.normal(size=2), rng=True)
+        x = graph.node("x", lambda z: z + np.random.randn(2), z)
+
+
+def test_simulator_seed():
+    sim = RngSimulator()
+    samples = sim.sample(N=10, seed=42)
+    assert len(np.unique(samples["z"][:, 0])) == 10
+    samples2 = sim.sample(N=10, seed=42, num_workers=2)
+    assert np.all(samples["x"] == samples2["x"])
+    sample = sim.sample(seed=42, indices=7)
+    assert np.all(sample["x"] == samples["x"][7])
+    samples3 = sim.sample(N=3, seed=42, indices=[7, 8, 9], vectorized=True)
+    assert np.all(samples3["z"] == samples["z"][7:])
+    # Changing one node's stream leaves the others unchanged
+    sample = sim.sample(seed=42, indices=7, conditions={"z": np.zeros(2)})
+    assert np.allclose(sample["x"], samples["x"][7] - samples["z"][7])
+    assert np.all(sim.sample(N=10, seed=43)["z"] != samples["z"])
+
+
+def test_simulator_seed_global_state():
+    class TorchSimulator(swyft.Simulator):
+        def build(self, graph):
+            graph.node("z", lambda: torch.randn(2), seed_torch=True)
+
+    sim = TorchSimulator()
+    np.random.seed(0)
+    torch.manual_seed(0)
+    expected = np.random.rand(), torch.rand(1)
+    np.random.seed(0)
+    torch.manual_seed(0)
+    samples = sim.sample(N=3, seed=1)
+    assert (np.random.rand(), torch.rand(1)) == expected  # Global state restored
+    assert torch.equal(sim.sample(N=3, seed=1)["z"], samples["z"])
+
+
+def test_simulator_asample():
+    sim = AsyncSimulator()
+    samples = asyncio.run(sim.asample(20, concurrency=5))
+    assert 2 < sim.max_active <= 10  # Across samples and nodes, within the limit
+    assert np.allclose(samples["x"], samples["z"] * 4.0)
+    sample = sim.sample()
+    assert np.allclose(sample["a"], sample["z"] * 2.0)
+    samples = sim.sample(3, vectorized=True)
+    assert samples["b"].shape == (3, 2)
+
+
+def test_simulator_sample_in_running_loop():
+    sim = AsyncSimulator()
+
+    async def main():
+        return sim.sample(3), sim.sample(3, vectorized=True)
+
+    samples, samples_vectorized = asyncio.run(main())
+    assert np.allclose(samples["x"], samples["z"] * 4.0)
+    assert samples_vectorized["b"].shape == (3, 2)
+
+
+def test_batched_resampler():
+    sim = Simulator()
+    samples = sim.sample(N=16)
+    resampler = sim.get_resampler(targets=["x"], batched=True)
+    dl = samples.get_dataloader(batch_size=8, on_after_load_batch=resampler)
+    batch = next(iter(dl))
+    assert isinstance(batch["x"], torch.Tensor)
+    assert batch["x"].shape == (8, 10)
+    assert not torch.allclose(batch["x"], torch.as_tensor(samples["x"][:8]))
+    assert torch.allclose(batch["f"], torch.as_tensor(samples["f"][:8]))
@@ -0,0 +1,406 @@
+import glob
+import multiprocessing
+import pickle
+import shutil
+import numpy as np
+import scipy.stats
+import torch
+import zarr
+import swyft
+
+from tests.test_simulator import Simulator
+
+
+def get_store(tmp_path, N=100, chunk_size=16, name="store.zarr", seed=None):
+    sim = Simulator()
+    shapes, dtypes = sim.get_shapes_and_dtypes()
+    store = swyft.ZarrStore(str(tmp_path / name))
+    store.init(N, chunk_size, shapes=shapes, dtypes=dtypes, seed=seed)
+    return sim, store
+
+
+def test_zarrstore_simulate(tmp_path):
+    sim, store = get_store(tmp_path)
+    store.simulate(sim, batch_size=30)
+    assert store.sims_required == 0
+    assert np.all(store["z"][:] != 0.0)
+
+
+def test_zarrstore_simulate_num_workers(tmp_path):
+    sim, store = get_store(tmp_path)
+    store.simulate(sim, batch_size=30, num_workers=2)
+    assert store.sims_required == 0
+    assert len(np.unique(store["z"][:, 0])) == len(store)
+
+
+def test_zarrstore_simulate_sample_fn(tmp_path):
+    sim, store = get_store(tmp_path)
+    store.simulate(sim.sample, batch_size=30, max_sims=60)
+    assert store.sims_required == 40
+    store.simulate(sim.sample, batch_size=30, num_workers=2)
+    assert store.sims_required == 0
+
+
+def _simulate_worker(path):
+    swyft.ZarrStore(path).simulate(Simulator())
+
+
+def test_zarrstore_concurrent_writers(tmp_path):
+    _, store = get_store(tmp_path, N=200, chunk_size=16, seed=1)
+    ctx = multiprocessing.get_context("fork")
+    workers = [
+        ctx.Process(target=_simulate_worker, args=(str(tmp_path / "store.zarr"),))
+        for _ in range(3)
+    ]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    assert store.sims_required == 0 and store.leases == {}
+    sim, store2 = get_store(tmp_path, N=200, chunk_size=16, name="store2.zarr", seed=1)
+    store2.simulate(sim)
+    assert np.all(store["x"][:] == store2["x"][:])
+
+
+def test_zarrstore_simulate_seed(tmp_path):
+    sim, store = get_store(tmp_path, seed=1)
+    store.simulate(sim, max_sims=40)
+    store.simulate(sim, num_workers=2)
+    _, store2 = get_store(tmp_path, name="store2.zarr", seed=1)
+    store2.simulate(sim)
+    assert np.all(store["x"][:] == store2["x"][:])
+
+
+def test_zarrstore_free_slot_index(tmp_path):
+    sim, store = get_store(tmp_path, N=100, chunk_size=16)
+    assert store.sims_required == 100
+    store._store_samples(sim.sample(10), idx=np.arange(20, 30))
+    assert store.sims_required == 90
+    store.simulate(sim.sample, batch_size=25, max_sims=25)
+    assert list(store.meta["chunk_pending"][:3]) == [0, 0, 13]
+    assert np.all(store.meta["sim_status"][:20] == 1)
+    assert store.root["meta"].attrs["cursor"] == 2
+    store.reset_length(120)
+    assert store.sims_required == 85
+    store.simulate(sim)
+    assert store.sims_required == 0
+    assert np.all(store.meta["sim_status"][:] == 1)
+
+
+def test_zarrstore_leases(tmp_path):
+    sim, store = get_store(tmp_path, N=100, chunk_size=16)
+    lease1, idx1 = store._lease_slots(30, timeout=3600.0)
+    lease2, idx2 = store._lease_slots(30, timeout=-1.0)  # Expires immediately
+    assert len(np.intersect1d(idx1, idx2)) == 0
+    assert np.all(store.meta["sim_status"][:32] == 2)  # Chunk-aligned
+    assert idx2[0] == 32
+    assert store.sims_required == 100
+    # Expired lease is reclaimed by the next worker
+    lease3, idx3 = store._lease_slots(100, timeout=3600.0)
+    assert len(idx3) == 68 and np.all(np.isin(idx2, idx3))
+    assert lease2 not in store.leases
+    assert store._store_samples(sim.sample(32), idx2, lease2) == 0
+    assert store._store_samples(sim.sample(32), idx1, lease1) == 32
+    assert store.sims_required == 68
+    store.simulate(sim)
+    assert store.sims_required == 68
+    store._store_samples(sim.sample(68), idx3, lease3)
+    assert store.sims_required == 0 and store.leases == {}
+
+
+def test_get_index_slices():
+    idx = [2, 3, 4, 8, 10, 11]
+    slices = swyft.lightning.data._get_index_slices(idx)
+    assert slices == [[[0, 3], [2, 5]], [[3, 4], [8, 9]], [[4, 6], [10, 12]]]
+    assert swyft.lightning.data._get_index_slices([]) == []
+
+
+def test_zarrstore_write_buffer(tmp_path):
+    sim, store = get_store(tmp_path, N=100, chunk_size=16)
+    store._simulate_batch(sim.sample, 10)
+    assert np.all(store.meta["sim_status"][:10] == 2)  # Buffered, not written
+    store._simulate_batch(sim.sample, 10)
+    assert np.all(store.meta["sim_status"][:16] == 1)  # First chunk complete
+    assert np.all(store.meta["sim_status"][16:20] == 2)
+    store.flush()
+    assert store.sims_required == 80 and store.leases == {}
+    assert np.all(store["z"][:20] != 0.0)
+
+
+def test_zarrstore_expired_lease(tmp_path, monkeypatch):
+    sim, store = get_store(tmp_path, N=32, chunk_size=16)
+    lease1, idx1 = store._lease_slots(16, timeout=3600.0)
+    samples2 = sim.sample(16)
+    to_files = swyft.lightning.data._StagingStore.to_files
+
+    def take_over(staging):
+        # The lease expires while staging, and another worker takes over
+        files = to_files(staging)
+        leases = store.leases
+        leases[lease1]["deadline"] = 0.0
+        store.root["meta"].attrs["leases"] = leases
+        lease2, idx2 = store._lease_slots(16, timeout=3600.0)
+        monkeypatch.setattr(swyft.lightning.data._StagingStore, "to_files", to_files)
+        assert store._store_samples(samples2, idx2, lease2) == 16
+        return files
+
+    monkeypatch.setattr(swyft.lightning.data._StagingStore, "to_files", take_over)
+    assert store._store_samples(sim.sample(16), idx1, lease1) == 0
+    assert np.all(store["z"][:16] == samples2["z"])
+    assert store.sims_required == 16 and store.leases == {}
+    assert glob.glob(str(tmp_path / "store.zarr" / "data" / "*" / "*.partial")) == []
+
+
+def test_zarrstore_crashed_writer(tmp_path):
+    sim, store = get_store(tmp_path, N=32, chunk_size=16)
+    lease, idx = store._lease_slots(16, timeout=-1.0)  # Expires immediately
+    # The worker crashes after writing temporary chunk files
+    staging = swyft.lightning.data._StagingStore(store.store)
+    data = zarr.open_group(store=staging, mode="r+")["data"]
+    data["z"][:16] = sim.sample(16)["z"]
+    staging.to_files()
+    pattern = str(tmp_path / "store.zarr" / "data" / "*" / "*.partial")
+    assert len(glob.glob(pattern)) == 1
+    store._lease_slots(16, timeout=3600.0)  # Reclaims the expired lease
+    assert glob.glob(pattern) == []
+
+
+def test_zarrstore_grow_leased_chunk(tmp_path):
+    sim, store = get_store(tmp_path, N=20, chunk_size=16)
+    store.simulate(sim, max_sims=16)
+    lease1, idx1 = store._lease_slots(4, timeout=3600.0)
+    # New slots in a leased chunk are held by the lease
+    assert list(store.grow(4)) == [20, 21, 22, 23]
+    assert len(store._lease_slots(4, timeout=3600.0)[1]) == 0
+    idx = store.append(sim.sample(4))
+    assert list(idx) == [32, 33, 34, 35]
+    assert np.all(store.meta["sim_status"][20:32] == 2)
+    store._store_samples(sim.sample(4), idx1, lease1)
+    assert store.sims_required == 12 and store.leases == {}
+    store.simulate(sim)
+    assert store.sims_required == 0
+    assert np.all(store["z"][:36] != 0.0)
+
+
+def test_zarrstore_codecs(tmp_path):
+    sim = Simulator()
+    shapes, dtypes = sim.get_shapes_and_dtypes()
+    codecs = {
+        "*": dict(cname="zstd", clevel=3, shuffle="bit"),
+        "x": dict(dtype="float16"),
+        "f": dict(dtype="bfloat16"),
+    }
+    store = swyft.ZarrStore(str(tmp_path / "store.zarr"))
+    store.init(50, 16, shapes=shapes, dtypes=dtypes, codecs=codecs)
+    store.simulate(sim)
+    assert store["x"].compressor.cname == "zstd"
+    assert store["x"].dtype == np.float32 and store["f"].dtype == np.float32
+    # Reopening decodes with registered codecs
+    store = swyft.ZarrStore(str(tmp_path / "store.zarr"))
+    f, z = store["f"][:], store["z"][:]
+    assert np.allclose(f, z[:, :1] + z[:, 1:] * sim.x, rtol=1e-2, atol=1e-2)
+    results = swyft.benchmark_codecs(
+        sim.sample(64),
+        {"lz4": None, "zstd": {"*": dict(cname="zstd", dtype="bfloat16")}},
+        chunk_size=16,
+        path=str(tmp_path),
+    )
+    assert results["zstd"]["x"]["nbytes_stored"] < results["lz4"]["x"]["nbytes_stored"]
+    assert results["lz4"]["x"]["read_mb_s"] > 0
+
+
+def test_zarrstore_batched_dataloader(tmp_path):
+    sim, store = get_store(tmp_path, N=100, chunk_size=16)
+    store.simulate(sim)
+    calls = []
+
+    def hook(batch):
+        calls.append(len(batch["x"]))
+        return dict(batch, y=batch["x"] * 2)
+
+    dl = store.get_dataloader(
+        batch_size=10, batched=True, drop_last=False, on_after_load_batch=hook
+    )
+    batches = list(dl)
+    assert [len(b["x"]) for b in batches] == [10] * 10
+    assert isinstance(batches[0]["y"], torch.Tensor)
+    assert torch.allclose(batches[0]["y"], 2 * batches[0]["x"])
+    z = torch.cat([b["z"] for b in batches]).numpy()
+    assert np.array_equal(np.sort(z[:, 0]), np.sort(store["z"][:, 0]))
+    dl = store.get_dataloader(batch_size=30, batched=True, idx_range=(0, 50))
+    assert [len(b["x"]) for b in dl] == [30]
+
+
+def test_zarrstore_prefetch(tmp_path):
+    sim, store = get_store(tmp_path, N=100, chunk_size=16)
+    store.simulate(sim)
+    ds = store.get_dataset(prefetch=2, read_threads=2)
+    z = np.stack([s["z"] for s in ds])
+    assert np.array_equal(np.sort(z[:, 0]), np.sort(store["z"][:, 0]))
+    # Stopping early shuts down the background thread
+    it = iter(store.get_dataset(prefetch=1, batch_size=4))
+    next(it)
+    it.close()
+
+
+def test_zarrstore_shuffle_buffer(tmp_path):
+    sim, store = get_store(tmp_path, N=100, chunk_size=16)
+    store.simulate(sim)
+    ds = store.get_dataset(shuffle_buffer_bytes=4 * 16 * 4 * (2 + 10 + 10))
+    assert ds.shuffle_chunks == 4
+    z = np.stack([s["z"] for s in ds])
+    assert np.array_equal(np.sort(z[:, 0]), np.sort(store["z"][:, 0]))
+    # First samples are drawn from several chunks
+    rows = [np.flatnonzero(store["z"][:, 0] == v)[0] // 16 for v in z[:16, 0]]
+    assert len(set(rows)) > 1
+
+
+def test_zarrstore_sharding(tmp_path):
+    sim, store = get_store(tmp_path, N=100, chunk_size=16)
+    store.simulate(sim)
+    z = store["z"][:, 0]
+    seen = []
+    for rank in range(3):
+        ds = store.get_dataset(rank=rank, world_size=3, batch_size=4, drop_last=False)
+        ds.set_epoch(1)
+        seen.append(np.concatenate([b["z"][:, 0] for b in ds]))
+    # Equal shard lengths, disjoint up to padding
+    assert [len(s) for s in seen] == [33, 33, 33]
+    assert len(np.unique(np.concatenate(seen))) >= 100 - 2 * 16
+    assert np.all(np.isin(np.concatenate(seen), z))
+    # Same epoch gives the same shards, other epochs differ
+    ds = store.get_dataset(rank=0, world_size=3)
+    ds.set_epoch(1)
+    assert set(s["z"][0] for s in ds) == set(seen[0])
+    ds.set_epoch(2)
+    assert set(s["z"][0] for s in ds) != set(seen[0])
+    # Uneven chunks of selected indices
+    indices = np.concatenate([np.arange(3), np.arange(16, 32), np.arange(40, 44)])
+    lengths = []
+    for rank in range(2):
+        ds = store.get_dataset(indices=indices, rank=rank, world_size=2)
+        shard = ds.get_shard(None)
+        assert all(n > 0 for _, n in shard)
+        lengths.append(sum(1 for _ in ds))
+        assert sum(n for _, n in shard) == lengths[-1]
+    assert lengths == [11, 11]
+
+
+def test_zarrstore_chunk_cache(tmp_path):
+    sim, store = get_store(tmp_path, N=100, chunk_size=16)
+    store.simulate(sim)
+    cache = store.enable_chunk_cache()
+    ds = store.get_dataset()
+    z1 = np.sort([s["z"][0] for s in ds])
+    assert cache.stats()["misses"] == 7 and cache.stats()["hits"] == 0
+    z2 = np.sort([s["z"][0] for s in ds])
+    assert cache.stats()["hits"] == 7
+    assert np.array_equal(z1, z2)
+    # Shared cache with counters across DataLoader workers
+    cache = store.enable_chunk_cache(shared=True, path=str(tmp_path / "cache"))
+    for epoch in range(2):
+        dl = store.get_dataloader(batch_size=10, num_workers=2, drop_last=False)
+        assert sum(len(b["z"]) for b in dl) == 100
+    assert cache.stats()["hits"] == 7 and cache.stats()["entries"] == 7
+    pickle.dumps(store.get_dataset())  # E.g. for the spawn start method
+    # Writes by another store instance invalidate cached chunks
+    _, store = get_store(tmp_path, name="store2.zarr")
+    store.simulate(sim, max_sims=50)
+    path = str(tmp_path / "cache2")
+    store.enable_chunk_cache(shared=True, path=path)
+    list(store.get_dataset())
+    swyft.ZarrStore(str(tmp_path / "store2.zarr")).simulate(sim)
+    store.enable_chunk_cache(shared=True, path=path)
+    z = np.sort([s["z"][0] for s in store.get_dataset()])
+    assert np.array_equal(z, np.sort(store["z"][:, 0]))
+    # As does re-creating the store
+    shutil.rmtree(tmp_path / "store2.zarr")
+    _, store = get_store(tmp_path, name="store2.zarr")
+    store.simulate(sim)
+    store.enable_chunk_cache(shared=True, path=path)
+    z = np.sort([s["z"][0] for s in store.get_dataset()])
+    assert np.array_equal(z, np.sort(store["z"][:, 0]))
+
+
+def test_zarrstore_append_and_grow(tmp_path):
+    sim, store = get_store(tmp_path, N=20, chunk_size=16)
+    store.simulate(sim)
+    idx = store.append(sim.sample(5))
+    assert list(idx) == [20, 21, 22, 23, 24]
+    assert len(store) == 25 and store.capacity == 40
+    assert store.sims_required == 0
+    assert np.all(store.meta["sim_status"][25:] == 3)
+    store.simulate(sim, max_sims=30, grow=True)
+    assert len(store) == 55 and store.capacity == 80
+    assert store.sims_required == 0
+    assert len(store.numpy()["z"]) == 55 and len(store[:]) == 55
+    assert np.all(store["z"][:55] != 0.0)
+    assert sum(1 for _ in store.get_dataset()) == 55
+    dm = swyft.SwyftDataModule(store, fractions=[0.6, 0.2, 0.2])
+    assert sum(dm.lengths) == 55
+    # Reopened store keeps its logical length
+    assert len(swyft.ZarrStore(str(tmp_path / "store.zarr"))) == 55
+
+
+def test_zarrstore_select(tmp_path):
+    sim = Simulator()
+    shapes, dtypes = sim.get_shapes_and_dtypes()
+    store = swyft.ZarrStore(str(tmp_path / "store.zarr"))
+    store.init(200, 16, shapes=shapes, dtypes=dtypes, zonemap_keys=["z"])
+    # Sorted z[0] makes chunks prunable
+    samples = sim.sample(200)
+    order = np.argsort(samples["z"][:, 0])
+    store._store_samples({k: v[order] for k, v in samples.items()}, np.arange(200))
+    bounds = np.array([[-0.2, 0.2], [-1.0, 1.0]])
+    z = store["z"][:]
+    expected = np.flatnonzero(np.all((z >= bounds[:, 0]) & (z <= bounds[:, 1]), axis=1))
+    idx = store.select(bounds, key="z")
+    assert np.array_equal(idx, expected)
+    zonemap_max = store.meta["zonemap_max"]["z"][:]
+    zonemap_min = store.meta["zonemap_min"]["z"][:]
+    assert np.sum((zonemap_max[:, 0] >= -0.2) & (zonemap_min[:, 0] <= 0.2)) < 13
+    selected = store.select(torch.tensor(bounds), return_samples=True)
+    assert np.array_equal(selected["x"], store["x"][:][expected])
+    # Zone maps are built for existing data, and grow with the store
+    store.enable_zonemaps(["x"])
+    store.append(sim.sample(10, conditions={"z": np.zeros(2)}))
+    idx = store.select([[-0.01, 0.01], [-0.01, 0.01]])
+    assert list(idx[-10:]) == list(range(200, 210))
+    assert np.isfinite(store.meta["zonemap_min"]["x"][:13]).all()
+    # Zone maps cover lossily stored values
+    store = swyft.ZarrStore(str(tmp_path / "lossy.zarr"))
+    codecs = {"z": dict(dtype="bfloat16")}
+    store.init(64, 16, shapes, dtypes, codecs=codecs, zonemap_keys=["z"])
+    store.simulate(sim)
+    z = store["z"][:].reshape(4, 16, 2)
+    assert np.all(store.meta["zonemap_min"]["z"][:] == z.min(axis=1))
+    assert np.all(store.meta["zonemap_max"]["z"][:] == z.max(axis=1))
+
+
+def test_zarrstore_reuse_across_rounds(tmp_path):
+    sim, store = get_store(tmp_path, N=400, chunk_size=16)
+    store.simulate(sim)
+    prior = scipy.stats.uniform(-np.ones(2), 2 * np.ones(2))
+    bounds = np.array([[0.0, 1.0], [0.0, 1.0]])
+    idx = store.simulate(sim, max_sims=100, bounds=bounds, prior=prior)
+    assert len(idx) == 100 and len(np.unique(idx)) == 100
+    z = store["z"].get_orthogonal_selection((idx,))
+    assert np.all((z >= 0.0) & (z <= 1.0))
+    assert len(store) < 500  # Stored samples were reused
+    assert np.allclose(store.data.attrs["reuse_bounds"], bounds)
+    # Simulated samples are consistent with their parameters
+    x = store["f"].get_orthogonal_selection((idx,))
+    assert np.allclose(x, z[:, :1] + z[:, 1:] * sim.x, atol=1e-5)
+    # Next round intersects the bounds
+    bounds = torch.tensor([[0.5, 2.0], [0.0, 1.0]])
+    idx = store.simulate(sim, max_sims=50, bounds=bounds, prior=prior)
+    z = store["z"].get_orthogonal_selection((idx,))
+    assert np.all((z[:, 0] >= 0.5) & (z[:, 1] >= 0.0))
+    assert np.allclose(store.data.attrs["reuse_bounds"], [[0.5, 1.0], [0.0, 1.0]])
+    # Training on the returned indices
+    ds = store.get_dataset(indices=idx, shuffle_chunks=2)
+    assert np.array_equal(np.sort([s["z"][0] for s in ds]), np.sort(z[:, 0]))
+    dm = swyft.SwyftDataModule(store, fractions=[0.6, 0.2, 0.2], indices=idx)
+    dm.setup("fit")
+    z_train = np.concatenate([b["z"] for b in dm.train_dataloader()])
+    assert len(z_train) == 30 and np.all(z_train[:, 0] >= 0.5)